@@ -9,11 +9,19 @@ import os
 import socket
 import boto
 import mmap
+import json
+import zlib
 from boto.s3.bucket import Key
+from boto.s3.connection import OrdinaryCallingFormat
 from boto.exception import S3ResponseError
 from boto.s3.multipart import MultiPartUpload
-from time import time
-from hashlib import sha1
+from boto.utils import compute_md5
+from time import time, sleep, localtime
+from collections import deque
+from StringIO import StringIO
+from hashlib import sha1, md5
+from threading import Thread, Event, Lock
+from Queue import Queue, Empty, Full
 
 
 # 'backup-agent'
@@ -22,26 +30,145 @@ _s3_secret_key = "g+nTih2ScjSC3nt0N/5uIKPu6fTEa0PFnpfJCgWm"
 _s3_bucket_name = "gwn-site-backup"
 _s3_sha1_meta_key = 'gwn-sha1'
 
-# Chunk size in megabytes for multipart uploads
+# Alternative S3-compatible endpoint (host:port, plain HTTP), e.g. s3_stub.py
+_s3_endpoint = None
+
+# Largest chunk size in megabytes for multipart uploads. The chunks are sized
+# from the file size and adapted to the observed throughput and errors.
 _chunk_size_mb = 100
 
+# S3 limits for multipart uploads
+_max_parts = 10000
+_min_part_size = 5 * 1024 * 1024
+
+# Chunks are sized to take about this long to send, so a retry on a slow or
+# lossy link does not resend too much
+_part_target_seconds = 30
+
+# The size of a stream from stdin is not known upfront. Its chunks start small
+# and double every so many chunks (up to the largest chunk size), which keeps
+# the memory use low and still allows streams of several hundred GB.
+_stream_part_size = 8 * 1024 * 1024
+_stream_part_growth = 1000
+
+# Largest key (or part of a key) S3 copies in one request
+_max_copy_size = 5 * 1024 * 1024 * 1024
+
 # What is the threshold for using multipart upload versus standart upload?
 _chunk_threshold_mb = 1024
 
-# Helper variables for standard transfer call-back method
-last_bytes = 0
-last_timestamp = 0
+# How many chunks to upload at the same time (each over its own connection),
+# and how often to try each chunk before giving up
+_concurrency = 4
+_part_attempts = 3
 
+# Unfinished multipart uploads are recorded here, so the next run can resume
+# them. This must not be the backup directory itself, or offsite-backup.sh
+# would pick up the manifests as backup files.
+_state_dir = '/var/tmp/backup_to_s3'
 
+# Unfinished uploads that were not resumed for this long are cancelled
+_state_max_age_days = 7
 
-def die(message, details=None):
+# SHA-1 checksums of local files by path, size, mtime and inode. Saves reading
+# huge files twice when a run is repeated (e.g. to resume a failed upload).
+_sha1_cache_file = os.path.join(_state_dir, 'sha1.cache')
+
+# Chunk store mode: files are cut where a hash of the preceding window of bytes
+# at a newline matches the mask (so about every 4 MB for random data), but
+# never into chunks smaller or larger than the limits. Since the cuts depend
+# on the content only, an insertion only changes the chunks around it.
+_cdc_window = 48
+_cdc_mask = 0x3fff
+_cdc_min_size = 1024 * 1024
+_cdc_max_size = 16 * 1024 * 1024
+_chunk_store_suffix = '.chunks'
+
+# Upload rate is reported as the average over this many seconds
+_rate_window = 10
+
+# Serializes the output of the upload threads
+print_lock = Lock()
+
+# Connections to S3 that are not in use, shared by all uploads of a run
+bucket_pool = Queue()
+
+
+
+def say(message):
     '''
-    Terminate the script with a big fat error message.
+    Print a line of output without interleaving it with other threads.
     '''
-    
+
+    with print_lock:
+        print message
+
+
+
+def connect_bucket(validate=True):
+    '''
+    Open a new connection to the backup bucket.
+    '''
+
+    if _s3_endpoint is not None:
+        (host, port) = _s3_endpoint.split(':')
+        conn = boto.connect_s3(_s3_access_key, _s3_secret_key, host=host, port=int(port),
+                               is_secure=False, calling_format=OrdinaryCallingFormat())
+    else:
+        conn = boto.connect_s3(_s3_access_key, _s3_secret_key)
+    return conn.get_bucket(_s3_bucket_name, validate=validate)
+
+
+
+def acquire_bucket():
+    '''
+    Take an idle connection from the pool, or open a new one.
+    '''
+
+    try:
+        return bucket_pool.get_nowait()
+    except Empty:
+        return connect_bucket(validate=False)
+
+
+
+def release_bucket(bucket):
+    '''
+    Return a connection to the pool for the next upload.
+    '''
+
+    bucket_pool.put(bucket)
+
+
+
+class TransferError(Exception):
+    '''
+    A file could not be backed up. The other files of the run are still tried.
+    '''
+
+    def __init__(self, message, details=None):
+        Exception.__init__(self, message)
+        self.details = details
+
+
+
+def report_error(message, details=None):
+    '''
+    Print a big fat error message.
+    '''
+
     print "\n***\n*** ERROR:", message, "\n***"
     if(details):
         print details
+
+
+
+def die(message, details=None):
+    '''
+    Terminate the script with a big fat error message.
+    '''
+    
+    report_error(message, details)
     sys.exit(1)
     
 
@@ -60,99 +187,1186 @@ def get_human_readable(size):
     return "%7.1f %s" % (size,suffixes[suffixIndex])
 
 
+
+class RateMeter(object):
+    '''
+    Moving average of the upload rate over the last _rate_window seconds, fed
+    by all upload threads.
+    '''
+
+    def __init__(self, window):
+        self.__window = window
+        self.__samples = deque()
+        self.__lock = Lock()
+
+    def add(self, size):
+        with self.__lock:
+            self.__samples.append((time(), size))
+
+    def rate(self):
+        with self.__lock:
+            now = time()
+            while self.__samples and self.__samples[0][0] < now - self.__window:
+                self.__samples.popleft()
+            if not self.__samples:
+                return 0.0
+            # Do not extrapolate from the first fraction of a second
+            span = max(now - self.__samples[0][0], 1.0)
+            return sum(s[1] for s in self.__samples) / span
+
+
+
+class TokenBucket(object):
+    '''
+    Bandwidth limit shared by all upload threads. The rate follows a time of
+    day profile, a list of (from_hour, to_hour, bytes_per_sec) entries. Hours
+    without an entry, and entries with a rate of 0, are not limited.
+    '''
+
+    def __init__(self, profile):
+        self.profile = profile
+        self.__tokens = 0.0
+        self.__last = time()
+        self.__lock = Lock()
+
+    def current_rate(self):
+        hour = localtime().tm_hour
+        for (from_hour, to_hour, rate) in self.profile:
+            if from_hour <= hour < to_hour:
+                return rate
+        return 0
+
+    def consume(self, size):
+        rate = self.current_rate()
+        if not rate:
+            return
+
+        # Tokens accumulate for at most a second, and may go into debt. The
+        # caller then waits until the debt is paid off.
+        with self.__lock:
+            now = time()
+            self.__tokens = min(self.__tokens + (now - self.__last) * rate, float(rate))
+            self.__last = now
+            self.__tokens -= size
+            wait = -self.__tokens / rate
+        if wait > 0:
+            sleep(wait)
+
+
+
+def parse_bandwidth_profile(profile):
+    '''
+    Parse a bandwidth profile like "0-6:0,6-24:512", in KB/s per range of
+    hours of the day.
+    '''
+
+    entries = []
+    for entry in profile.split(','):
+        (hours, rate) = entry.split(':')
+        (from_hour, to_hour) = hours.split('-')
+        entries.append((int(from_hour), int(to_hour), int(rate) * 1024))
+    return entries
+
+
+
+# Shared by all uploads of a run
+upload_meter = RateMeter(_rate_window)
+upload_limit = TokenBucket([])
+
+
+
+class ThrottledFile(object):
+    '''
+    File wrapper that keeps boto's reads for sending within the bandwidth
+    limit, and feeds the rate meter.
+    '''
+
+    def __init__(self, fp):
+        self.__fp = fp
+
+    def read(self, size=-1):
+        data = self.__fp.read(size)
+        upload_limit.consume(len(data))
+        upload_meter.add(len(data))
+        return data
+
+    def seek(self, offset, whence=os.SEEK_SET):
+        return self.__fp.seek(offset, whence)
+
+    def tell(self):
+        return self.__fp.tell()
+
+
+
+def throttled_send(fp, send, **kwargs):
+    '''
+    Call a boto upload function for fp through the bandwidth limit. The MD5 is
+    calculated upfront, or boto would read the data for it at limited speed.
+    '''
+
+    (hex_md5, b64_md5, size) = compute_md5(fp)
+    return send(ThrottledFile(fp), md5=(hex_md5, b64_md5), size=size, **kwargs)
+
+
     
 def progress(part, total):
     '''
     Call-back function that is called by the S3 standard upload thread.
     '''
     
-    global last_bytes
-    global last_timestamp
-    
-    byte_per_sec = (part - last_bytes) / (time() - last_timestamp)
-    
     if (part != total):
         print "    - Transfered %s of %s so far: %3d%%    (%s/s)" \
-            % (get_human_readable(part), get_human_readable(total), (part * 100 / total), get_human_readable(byte_per_sec))
+            % (get_human_readable(part), get_human_readable(total), (part * 100 / total),
+               get_human_readable(upload_meter.rate()))
     else:
         print "    - Transfered %s of %s       : 100%%" % (get_human_readable(part), get_human_readable(total))        
-    
-    last_bytes = part
-    last_timestamp = time()
 
 
 def standard_transfer(k, myfile, meta):
     '''
     Perform the standard upload for files smaller than the _chunk_threshold_mb variable.
     '''
-    global last_timestamp
     print "\n* Starting standard transfer"
-    last_timestamp = time()
     for key in meta.keys():
         k.set_metadata(key, meta[key])
 
-    k.set_contents_from_file(myfile, reduced_redundancy=False, encrypt_key=True,
-                             cb=progress, num_cb=10)
+    throttled_send(myfile, k.set_contents_from_file, reduced_redundancy=False, encrypt_key=True,
+                   cb=progress, num_cb=10)
     
 
-def multipart_transfer(bucket, k, myfile, file_size, meta):
+class UploadManifest(object):
+    '''
+    Local record of a multipart upload and the chunks that already made it to
+    S3 (with their ETags). Updated after every chunk, so an interrupted upload
+    can be resumed by the next run.
+    '''
+
+    def __init__(self, path):
+        self.path = path
+        self.state = None
+        self.__lock = Lock()
+        try:
+            with open(path, 'r') as f:
+                self.state = json.load(f)
+        except (IOError, ValueError):
+            pass
+
+    def start(self, state):
+        with self.__lock:
+            self.state = state
+            self.__save()
+
+    def plan_part(self, part_num, offset, length):
+        with self.__lock:
+            self.state['planned'][str(part_num)] = [offset, length]
+            self.__save()
+
+    def add_part(self, part_num, etag):
+        with self.__lock:
+            self.state['parts'][str(part_num)] = etag
+            self.__save()
+
+    def remove(self):
+        try:
+            os.unlink(self.path)
+        except OSError:
+            pass
+
+    def __save(self):
+        if not os.path.isdir(_state_dir):
+            os.makedirs(_state_dir)
+        temp_file = self.path + '.tmp'
+        with open(temp_file, 'w') as f:
+            json.dump(self.state, f)
+        os.rename(temp_file, self.path)
+
+
+
+def get_manifest_path(key_str):
+    '''
+    Name of the manifest file for uploads to the given key.
+    '''
+
+    return os.path.join(_state_dir, key_str.strip('/').replace('/', '_') + '.json')
+
+
+
+def cancel_upload(bucket, key_name, upload_id):
+    '''
+    Cancel an unfinished multipart upload, so S3 does not keep (and bill) its chunks.
+    '''
+
+    try:
+        bucket.cancel_multipart_upload(key_name, upload_id)
+    except S3ResponseError as e:
+        # Already gone, or completed after all
+        if e.status != 404:
+            raise
+
+
+
+def expire_manifests(bucket):
+    '''
+    Cancel the uploads of manifests that have not been resumed for a while.
+    Backup file names contain the date, so these will never be resumed.
+    '''
+
+    if not os.path.isdir(_state_dir):
+        return
+
+    for name in os.listdir(_state_dir):
+        path = os.path.join(_state_dir, name)
+        if not name.endswith('.json'):
+            continue
+        if time() - os.path.getmtime(path) < _state_max_age_days * 86400:
+            continue
+
+        manifest = UploadManifest(path)
+        if manifest.state is not None:
+            print "  Cancelling abandoned upload of", manifest.state['key']
+            try:
+                cancel_upload(bucket, manifest.state['key'], manifest.state['upload_id'])
+            except S3ResponseError as e:
+                print "  Could not cancel upload:", e
+                continue
+        manifest.remove()
+
+
+
+def get_pending_uploads():
+    '''
+    Local files of the multipart uploads that a manifest says are unfinished.
+    Backup file names contain the date, so an upload that failed is not
+    retried by the next run over the files of the next day unless it is
+    added to them.
+    '''
+
+    pending = []
+    if not os.path.isdir(_state_dir):
+        return pending
+
+    for name in sorted(os.listdir(_state_dir)):
+        if not name.endswith('.json'):
+            continue
+        manifest = UploadManifest(os.path.join(_state_dir, name))
+        # Manifests from before the path was recorded cannot be matched to a file
+        path = manifest.state.get('path') if manifest.state is not None else None
+        if path is not None and os.path.isfile(path):
+            pending.append(path)
+    return pending
+
+
+
+def resume_upload(bucket, manifest, state):
+    '''
+    Try to pick up the multipart upload recorded in the manifest. Returns the
+    upload and the numbers of the chunks that are already on S3, or None if
+    there is nothing to resume.
+    '''
+
+    recorded = manifest.state
+    if recorded is None:
+        return None
+
+    for field in ['key', 'file_size', 'sha1']:
+        if recorded.get(field) != state[field]:
+            # The file changed since the last attempt, start over
+            print "  Local file changed since the last attempt. Starting over."
+            cancel_upload(bucket, recorded['key'], recorded['upload_id'])
+            return None
+
+    if 'planned' not in recorded:
+        # Made with fixed size chunks, before they were planned one by one
+        print "  Cannot resume the last attempt. Starting over."
+        cancel_upload(bucket, recorded['key'], recorded['upload_id'])
+        return None
+
+    multipart_upload = MultiPartUpload(bucket)
+    multipart_upload.key_name = recorded['key']
+    multipart_upload.id = recorded['upload_id']
+
+    try:
+        remote_parts = dict((p.part_number, p.etag.strip('"')) for p in multipart_upload)
+    except S3ResponseError as e:
+        if e.status != 404:
+            raise
+        print "  Previous upload no longer exists. Starting over."
+        return None
+
+    # Only trust chunks that S3 and the manifest agree on
+    done = set()
+    for (part_num, etag) in recorded['parts'].iteritems():
+        if remote_parts.get(int(part_num)) == etag:
+            done.add(int(part_num))
+
+    state['parts'] = dict((str(p), remote_parts[p]) for p in done)
+    state['planned'] = recorded['planned']
+    state['upload_id'] = recorded['upload_id']
+    manifest.start(state)
+    return (multipart_upload, done)
+
+
+
+def get_file_checksums(path, myfile):
+    '''
+    Return the SHA-1 and MD5 checksums of the local file. They are taken from
+    the checksum cache if the file has not changed since they were last
+    calculated. The MD5 checksum is what S3 lists as the ETag of a file that
+    was uploaded in one piece.
+    '''
+
+    path = os.path.realpath(path)
+    st = os.fstat(myfile.fileno())
+    signature = [st.st_size, st.st_mtime, st.st_ino]
+
+    try:
+        with open(_sha1_cache_file, 'r') as f:
+            cache = json.load(f)
+    except (IOError, ValueError):
+        cache = {}
+
+    entry = cache.get(path)
+    if entry is not None and entry['signature'] == signature and 'md5' in entry:
+        return (entry['sha1'], entry['md5'])
+
+    myfile.seek(0)
+    checksum = sha1()
+    md5_checksum = md5()
+    buff = myfile.read(1024 * 1024)
+    while buff:
+        checksum.update(buff)
+        md5_checksum.update(buff)
+        buff = myfile.read(1024 * 1024)
+    myfile.seek(0)
+
+    # Forget files that are gone, the backup directory is rotated daily
+    for p in cache.keys():
+        if not os.path.exists(p):
+            del cache[p]
+    cache[path] = { 'signature': signature, 'sha1': checksum.hexdigest(),
+                    'md5': md5_checksum.hexdigest() }
+
+    # Not being able to save the cache only costs time on the next run
+    temp_file = '{0}.{1}'.format(_sha1_cache_file, os.getpid())
+    try:
+        if not os.path.isdir(_state_dir):
+            os.makedirs(_state_dir)
+        with open(temp_file, 'w') as f:
+            json.dump(cache, f)
+        os.rename(temp_file, _sha1_cache_file)
+    except (IOError, OSError) as e:
+        say("  Could not save checksum cache: {0}".format(e))
+
+    return (checksum.hexdigest(), md5_checksum.hexdigest())
+
+
+
+class PartPlanner(object):
     '''
-    Any transfer over 5 GB needs to be done using multipart upload.
+    Hands out the chunks of a multipart upload to the upload threads. Each new
+    chunk is sized from what is left of the file, the S3 limits and how the
+    previous chunks went: smaller after errors, and about as large as can be
+    sent in _part_target_seconds otherwise. Chunks planned by an earlier run
+    that did not make it to S3 come first, with their original size.
+    '''
+
+    def __init__(self, file_size, concurrency, manifest, done):
+        self.__file_size = file_size
+        self.__concurrency = concurrency
+        self.__manifest = manifest
+        self.__lock = Lock()
+        self.__max_size = max(_chunk_size_mb * 1024 * 1024, _min_part_size)
+
+        planned = dict((int(n), r) for (n, r) in manifest.state['planned'].iteritems())
+        self.__retry = deque(sorted((n, r[0], r[1]) for (n, r) in planned.iteritems() if n not in done))
+        self.__next_num = max(planned.keys()) + 1 if planned else 1
+        self.__next_offset = max(r[0] + r[1] for r in planned.values()) if planned else 0
+
+        # Enough chunks to keep all threads busy a few times over
+        self.part_size = min(max(file_size / (concurrency * 4), _min_part_size), self.__max_size)
+
+    def next_part(self):
+        '''
+        Return the next chunk (number, offset, length) to send, or None.
+        '''
+        with self.__lock:
+            if self.__retry:
+                return self.__retry.popleft()
+
+            remaining = self.__file_size - self.__next_offset
+            if remaining <= 0:
+                return None
+
+            size = self.part_size
+            # Split the tail between the threads
+            size = min(size, max(remaining / self.__concurrency, _min_part_size))
+            # Never run out of part numbers
+            parts_left = _max_parts - self.__next_num + 1
+            size = max(size, (remaining + parts_left - 1) / parts_left)
+            size = min(size, remaining)
+
+            part = (self.__next_num, self.__next_offset, size)
+            self.__manifest.plan_part(*part)
+            self.__next_num += 1
+            self.__next_offset += size
+            return part
+
+    def report(self, length, seconds, success):
+        '''
+        Adapt the size of the next chunks to how a chunk went.
+        '''
+        with self.__lock:
+            if not success:
+                size = self.part_size / 2
+            else:
+                # Move towards the target, but at most by a factor of two per chunk
+                target = length / max(seconds, 0.001) * _part_target_seconds
+                size = min(max(target, self.part_size / 2), self.part_size * 2)
+            self.part_size = int(min(max(size, _min_part_size), self.__max_size))
+
+    def finished(self):
+        with self.__lock:
+            return not self.__retry and self.__next_offset >= self.__file_size
+
+
+
+def upload_part(multipart_upload, manifest, planner, myfile, part_num, offset, length):
+    '''
+    Upload one chunk of the file, retrying a few times if it fails, and record
+    it in the manifest. Returns True if the chunk was uploaded.
+    '''
+
+    # mmap only maps from a multiple of the allocation granularity, so the
+    # chunk is mapped from the boundary before it and read from its start.
+    # Chunks are sized freely, and earlier runs planned them that way too.
+    skip = offset % mmap.ALLOCATIONGRANULARITY
+
+    for attempt in range(1, _part_attempts + 1):
+        mm = None
+        start = time()
+        try:
+            mm = mmap.mmap(myfile.fileno(), prot=mmap.PROT_READ, length=skip + length,
+                           offset=offset - skip)
+            mm.seek(skip)
+            part = throttled_send(mm, multipart_upload.upload_part_from_file, part_num=part_num)
+            manifest.add_part(part_num, part.etag.strip('"'))
+            planner.report(length, time() - start, True)
+            byte_per_sec = length / ( time() - start + 0.01)
+            say("   Sent chunk {0} at {1}/s. Size: {2}. Total: {3}/s.".format(part_num,
+                    get_human_readable(byte_per_sec), get_human_readable(length),
+                    get_human_readable(upload_meter.rate())))
+            return True
+        except Exception as e:
+            planner.report(length, time() - start, False)
+            say("   Chunk {0} failed (attempt {1} of {2}): {3}".format(part_num, attempt, _part_attempts, e))
+            if attempt < _part_attempts:
+                sleep(attempt * 10)
+        finally:
+            if mm is not None:
+                mm.close()
+
+    return False
+
+
+
+class PartUploadThread(Thread):
+    '''
+    Worker that uploads the chunks handed out by the planner over its own S3
+    connection.
+    '''
+
+    def __init__(self, upload_id, key_name, manifest, planner, myfile, failed, name):
+        Thread.__init__(self, name=name)
+        self.daemon = True
+        self.__upload_id = upload_id
+        self.__key_name = key_name
+        self.__manifest = manifest
+        self.__planner = planner
+        self.__myfile = myfile
+        self.__failed = failed
+
+    def run(self):
+        bucket = None
+        try:
+            bucket = acquire_bucket()
+            multipart_upload = MultiPartUpload(bucket)
+            multipart_upload.key_name = self.__key_name
+            multipart_upload.id = self.__upload_id
+
+            while not self.__failed.is_set():
+                part = self.__planner.next_part()
+                if part is None:
+                    return
+                if not upload_part(multipart_upload, self.__manifest, self.__planner, self.__myfile, *part):
+                    self.__failed.set()
+        except BaseException as e:
+            say("   Upload thread {0} failed: {1}".format(self.name, e))
+            self.__failed.set()
+        finally:
+            if bucket is not None:
+                release_bucket(bucket)
+
+
+
+class ChecksumThread(Thread):
+    '''
+    Calculates the checksums of the files ahead of their upload, so reading the
+    next file overlaps with sending the current one.
+    '''
+
+    def __init__(self, filenames):
+        Thread.__init__(self, name='Checksum')
+        self.daemon = True
+        self.__filenames = filenames
+        self.results = Queue(maxsize=1)
+
+    def run(self):
+        for filename in self.__filenames:
+            try:
+                with open(filename, 'rb') as myfile:
+                    self.results.put((get_file_checksums(filename, myfile), None))
+            except Exception as e:
+                self.results.put(((None, None), e))
+
+
+
+def multipart_transfer(bucket, k, myfile, file_size, meta, concurrency):
+    '''
+    Any transfer over 5 GB needs to be done using multipart upload. The chunks
+    are uploaded by several threads in parallel. If the upload fails, it is
+    left on S3 and the next run only sends the missing chunks.
     '''
     
-    chunk_size = 1024 * 1024 * _chunk_size_mb
-    chunks = file_size / chunk_size
-    print "\n* Starting multipart transfer with {0} chunks of {1} each".format(chunks, get_human_readable(chunk_size))
-    multipart_upload = None
+    manifest = UploadManifest(get_manifest_path(k.key))
+    state = { 'key': k.key, 'path': os.path.realpath(myfile.name), 'file_size': file_size,
+              'sha1': meta[_s3_sha1_meta_key], 'parts': {}, 'planned': {} }
+
+    try:
+        resumed = resume_upload(bucket, manifest, state)
+        if resumed is not None:
+            (multipart_upload, done) = resumed
+            sent = sum(state['planned'][str(p)][1] for p in done)
+            print "\n* Resuming multipart transfer, {0} chunks ({1}) already sent".format(len(done),
+                    get_human_readable(sent))
+        else:
+            multipart_upload = bucket.initiate_multipart_upload(k, reduced_redundancy=False,
+                    encrypt_key=True, metadata=meta)
+            done = set()
+            state['upload_id'] = multipart_upload.id
+            manifest.start(state)
+    except Exception as e:
+        raise TransferError("Unable to start multipart upload", "Error: {0}".format(e))
+
+    planner = PartPlanner(file_size, concurrency, manifest, done)
+    print "\n* Starting multipart transfer of {0} with chunks of {1} to begin with, {2} at a time".format(
+            get_human_readable(file_size), get_human_readable(planner.part_size), concurrency)
     
     try:
-        multipart_upload = bucket.initiate_multipart_upload(k, reduced_redundancy=False,
-                encrypt_key=True, metadata=meta)
-        for c in range(0, chunks + 1):
-            offset = c * chunk_size
-            length = min(chunk_size, file_size-(c*chunk_size))            
-            mm = mmap.mmap(myfile.fileno(), prot=mmap.PROT_READ, length=length, offset=offset)
-            start = time()
-            multipart_upload.upload_part_from_file(mm, c+1)
-            byte_per_sec = length / ( time() - start + 0.01)
-            print "   Sent chunk {0} of {1} at {2}/s. Size: {3}.".format(c+1, chunks+1,
-                    get_human_readable(byte_per_sec), get_human_readable(length))
+        failed = Event()
+        threads = []
+        for i in range(0, concurrency):
+            t = PartUploadThread(multipart_upload.id, multipart_upload.key_name, manifest, planner,
+                                 myfile, failed, 'Upload{0}'.format(i))
+            t.start()
+            threads.append(t)
+
+        # Join with a timeout, so Ctrl-C still reaches the main thread
+        for t in threads:
+            while t.is_alive():
+                t.join(1)
+
+        if failed.is_set() or not planner.finished():
+            raise Exception("Giving up on the failed chunks")
             
         multipart_upload.complete_upload()
-    except BaseException as e:
-        if multipart_upload is not None:
-            multipart_upload.cancel_upload()
-            die("Multipart upload failed", "Error: {0}".format(type(e)))
-    
+    except Exception as e:
+        raise TransferError("Multipart upload failed. Run again to resume it.", "Error: {0}".format(e))
+
+    manifest.remove()
+
+
+
+def get_stream_part_size(part_num):
+    '''
+    Size of the given chunk of a stream. Later chunks are larger, so a stream
+    of unknown size stays within the part limit of S3.
+    '''
+
+    size = _stream_part_size << ((part_num - 1) / _stream_part_growth)
+    return min(size, max(_chunk_size_mb * 1024 * 1024, _min_part_size))
+
+
+
+def upload_stream_part(multipart_upload, part_num, data):
+    '''
+    Upload one chunk of a stream, retrying a few times if it fails. Returns
+    True if the chunk was uploaded.
+    '''
+
+    for attempt in range(1, _part_attempts + 1):
+        start = time()
+        try:
+            throttled_send(StringIO(data), multipart_upload.upload_part_from_file, part_num=part_num)
+            byte_per_sec = len(data) / (time() - start + 0.01)
+            say("   Sent chunk {0} at {1}/s. Size: {2}. Total: {3}/s.".format(part_num,
+                    get_human_readable(byte_per_sec), get_human_readable(len(data)),
+                    get_human_readable(upload_meter.rate())))
+            return True
+        except Exception as e:
+            say("   Chunk {0} failed (attempt {1} of {2}): {3}".format(part_num, attempt, _part_attempts, e))
+            if attempt < _part_attempts:
+                sleep(attempt * 10)
+
+    return False
+
+
+
+class StreamUploadThread(Thread):
+    '''
+    Worker that uploads the chunks of a stream from the chunk queue.
+    '''
+
+    def __init__(self, upload_id, key_name, chunk_queue, failed, name):
+        Thread.__init__(self, name=name)
+        self.daemon = True
+        self.__upload_id = upload_id
+        self.__key_name = key_name
+        self.__chunk_queue = chunk_queue
+        self.__failed = failed
+
+    def run(self):
+        bucket = None
+        multipart_upload = None
+        try:
+            bucket = acquire_bucket()
+            multipart_upload = MultiPartUpload(bucket)
+            multipart_upload.key_name = self.__key_name
+            multipart_upload.id = self.__upload_id
+        except Exception as e:
+            say("   Upload thread {0} failed: {1}".format(self.name, e))
+            self.__failed.set()
+
+        # Keep draining the queue after a failure, so the reader does not block
+        while True:
+            item = self.__chunk_queue.get()
+            if item is None:
+                break
+            if not self.__failed.is_set() and not upload_stream_part(multipart_upload, *item):
+                self.__failed.set()
+
+        if bucket is not None:
+            release_bucket(bucket)
+
+
+
+def set_key_metadata(bucket, key_str, size, meta):
+    '''
+    Replace the metadata of a key by copying the key onto itself. S3 copies
+    keys over 5 GB only in parts.
+    '''
+
+    # As in list_remote_keys, the key on S3 does not have the leading slash
+    source = key_str.lstrip('/')
+    if size <= _max_copy_size:
+        bucket.copy_key(key_str, bucket.name, source, metadata=meta, encrypt_key=True)
+        return
+
+    multipart_upload = bucket.initiate_multipart_upload(key_str, reduced_redundancy=False,
+            encrypt_key=True, metadata=meta)
+    try:
+        for (i, offset) in enumerate(range(0, size, _max_copy_size)):
+            multipart_upload.copy_part_from_key(bucket.name, source, i + 1, offset,
+                                                min(offset + _max_copy_size, size) - 1)
+        multipart_upload.complete_upload()
+    except BaseException:
+        cancel_upload(bucket, multipart_upload.key_name, multipart_upload.id)
+        raise
+
+
+
+def stream_transfer(bucket, key_str, stream, concurrency):
+    '''
+    Upload a stream of unknown size as a multipart upload, with only a few
+    chunks in memory at a time. The checksum is only known at the end, so it
+    is added to the key afterwards. Unlike for files, a failed upload cannot be
+    resumed, since the stream is gone. Returns the checksum.
+    '''
+
+    checksum = sha1()
+    data = stream.read(get_stream_part_size(1))
+    checksum.update(data)
+
+    # Short streams fit into a single chunk
+    if len(data) < get_stream_part_size(1):
+        k = Key(bucket)
+        k.storage_class='STANDARD_IA'
+        k.key = key_str
+        try:
+            standard_transfer(k, StringIO(data), { _s3_sha1_meta_key : checksum.hexdigest() })
+        except Exception as e:
+            raise TransferError("Standard upload failed", "Error: {0}".format(e))
+        return checksum.hexdigest()
+
+    try:
+        multipart_upload = bucket.initiate_multipart_upload(key_str, reduced_redundancy=False,
+                encrypt_key=True)
+    except Exception as e:
+        raise TransferError("Unable to start multipart upload", "Error: {0}".format(e))
+
+    print "\n* Starting streaming transfer, {0} at a time".format(concurrency)
+
+    # Bounded, so the reader cannot run away from the uploads
+    chunk_queue = Queue(maxsize=concurrency)
+    failed = Event()
+    threads = []
+    for i in range(0, concurrency):
+        t = StreamUploadThread(multipart_upload.id, multipart_upload.key_name, chunk_queue, failed,
+                               'Upload{0}'.format(i))
+        t.start()
+        threads.append(t)
+
+    part_num = 1
+    size = 0
+    try:
+        while data and not failed.is_set():
+            if part_num > _max_parts:
+                say("   Stream exceeds the part limit of S3")
+                failed.set()
+                break
+            # Put with a timeout, so Ctrl-C still reaches the main thread
+            while True:
+                try:
+                    chunk_queue.put((part_num, data), True, 1)
+                    break
+                except Full:
+                    pass
+            size += len(data)
+            part_num += 1
+            data = stream.read(get_stream_part_size(part_num))
+            checksum.update(data)
+    finally:
+        for t in threads:
+            chunk_queue.put(None)
+        # Join with a timeout, so Ctrl-C still reaches the main thread
+        for t in threads:
+            while t.is_alive():
+                t.join(1)
+
+    try:
+        if failed.is_set():
+            raise Exception("Giving up on the failed chunks")
+        multipart_upload.complete_upload()
+    except Exception as e:
+        cancel_upload(bucket, multipart_upload.key_name, multipart_upload.id)
+        # Read the stream to its end, so a tee in front of us does not fail
+        while stream.read(1024 * 1024):
+            pass
+        raise TransferError("Streaming upload failed", "Error: {0}".format(e))
+
+    print "  Sent {0} in {1} chunks".format(get_human_readable(size), part_num - 1)
+
+    print "\n* Adding checksum to the remote file"
+    try:
+        set_key_metadata(bucket, key_str, size, { _s3_sha1_meta_key : checksum.hexdigest() })
+    except Exception as e:
+        raise TransferError("Unable to add the checksum. The next backup of the file will send it again.",
+                            "Error: {0}".format(e))
+
+    return checksum.hexdigest()
+
+
+def find_chunk_boundary(buff, eof):
+    '''
+    Return where the next chunk of the buffer ends, or None if more data is
+    needed to tell.
+    '''
+
+    limit = min(len(buff), _cdc_max_size)
+    pos = buff.find('\n', _cdc_min_size - 1)
+    while 0 <= pos < limit:
+        if zlib.crc32(buff[pos - _cdc_window:pos]) & _cdc_mask == 0:
+            return pos + 1
+        pos = buff.find('\n', pos + 1)
+
+    if len(buff) >= _cdc_max_size or eof:
+        return limit
+    return None
+
+
+
+def content_defined_chunks(myfile):
+    '''
+    Read the file and yield it in content-defined chunks.
+    '''
+
+    buff = ''
+    eof = False
+    while buff or not eof:
+        cut = find_chunk_boundary(buff, eof)
+        if cut is None:
+            data = myfile.read(_cdc_max_size)
+            eof = not data
+            buff += data
+            continue
+        yield buff[:cut]
+        buff = buff[cut:]
+
+
+
+def get_chunk_key(host_name, chunk_sha1):
+    '''
+    Name of the remote key of a chunk in the chunk store.
+    '''
+
+    return '/' + host_name + '/chunks/' + chunk_sha1
+
+
+
+def upload_chunk(bucket, key_str, data):
+    '''
+    Upload a single chunk of the chunk store, retrying a few times if it fails.
+    Returns True if the chunk was uploaded.
+    '''
+
+    for attempt in range(1, _part_attempts + 1):
+        try:
+            k = Key(bucket)
+            k.storage_class='STANDARD_IA'
+            k.key = key_str
+            throttled_send(StringIO(data), k.set_contents_from_file, reduced_redundancy=False,
+                           encrypt_key=True)
+            return True
+        except Exception as e:
+            say("   Chunk {0} failed (attempt {1} of {2}): {3}".format(key_str, attempt, _part_attempts, e))
+            if attempt < _part_attempts:
+                sleep(attempt * 10)
+
+    return False
+
+
+
+class ChunkUploadThread(Thread):
+    '''
+    Worker that uploads new chunks of the chunk store from the chunk queue.
+    '''
+
+    def __init__(self, chunk_queue, failed, name):
+        Thread.__init__(self, name=name)
+        self.daemon = True
+        self.__chunk_queue = chunk_queue
+        self.__failed = failed
+
+    def run(self):
+        bucket = None
+        try:
+            bucket = acquire_bucket()
+        except Exception as e:
+            say("   Upload thread {0} failed: {1}".format(self.name, e))
+            self.__failed.set()
+
+        # Keep draining the queue after a failure, so the reader does not block
+        while True:
+            item = self.__chunk_queue.get()
+            if item is None:
+                break
+            if not self.__failed.is_set() and not upload_chunk(bucket, item[0], item[1]):
+                self.__failed.set()
+
+        if bucket is not None:
+            release_bucket(bucket)
+
+
+
+def chunk_store_transfer(k, myfile, meta, host_name, known_chunks, concurrency):
+    '''
+    Store the file as content-defined chunks, named by their SHA-1 checksum.
+    Only chunks that are not in the Cloud yet are sent. The key itself just
+    lists the chunks that make up the file.
+    '''
+
+    print "\n* Starting chunk store transfer, {0} at a time".format(concurrency)
+
+    # Bounded, so the reader cannot run away from the uploads
+    chunk_queue = Queue(maxsize=concurrency)
+    failed = Event()
+    threads = []
+    for i in range(0, concurrency):
+        t = ChunkUploadThread(chunk_queue, failed, 'Chunk{0}'.format(i))
+        t.start()
+        threads.append(t)
+
+    chunks = []
+    new_chunks = []
+    sent_bytes = 0
+    start = time()
+    try:
+        for data in content_defined_chunks(myfile):
+            chunk_sha1 = sha1(data).hexdigest()
+            chunks.append([chunk_sha1, len(data)])
+            chunk_key = get_chunk_key(host_name, chunk_sha1)
+            if chunk_key not in known_chunks:
+                chunk_queue.put((chunk_key, data))
+                known_chunks.add(chunk_key)
+                new_chunks.append(chunk_key)
+                sent_bytes += len(data)
+            if failed.is_set():
+                break
+    finally:
+        for t in threads:
+            chunk_queue.put(None)
+        # Join with a timeout, so Ctrl-C still reaches the main thread
+        for t in threads:
+            while t.is_alive():
+                t.join(1)
+
+    if failed.is_set():
+        # Some of the new chunks may be missing, do not trust them next time
+        known_chunks.difference_update(new_chunks)
+        raise TransferError("Chunk store upload failed")
+
+    byte_per_sec = sent_bytes / (time() - start + 0.01)
+    print "  Sent {0} of {1} chunks ({2}) at {3}/s.".format(len(new_chunks), len(chunks),
+            get_human_readable(sent_bytes), get_human_readable(byte_per_sec))
+
+    for key in meta.keys():
+        k.set_metadata(key, meta[key])
+    k.set_contents_from_string(json.dumps({ 'sha1': meta[_s3_sha1_meta_key], 'chunks': chunks }),
+                               reduced_redundancy=False, encrypt_key=True)
+
+
+
+def restore_from_chunk_store(bucket, filename, key_str, host_name):
+    '''
+    Rebuild a file from its list of chunks in the chunk store.
+    '''
+
+    print "\n* Restoring {0} from {1}".format(filename, key_str)
+
+    k = bucket.get_key(key_str)
+    if not k:
+        raise TransferError("No such file in the chunk store: " + key_str)
+    manifest = json.loads(k.get_contents_as_string())
+
+    checksum = sha1()
+    try:
+        with open(filename, 'wb') as myfile:
+            for (chunk_sha1, length) in manifest['chunks']:
+                data = Key(bucket, get_chunk_key(host_name, chunk_sha1)).get_contents_as_string()
+                if len(data) != length or sha1(data).hexdigest() != chunk_sha1:
+                    raise TransferError("Chunk {0} is damaged".format(chunk_sha1))
+                checksum.update(data)
+                myfile.write(data)
+
+        if checksum.hexdigest() != manifest['sha1']:
+            raise TransferError("Checksum of the restored file does not match")
+    except BaseException:
+        # Do not leave a half restored file behind
+        if os.path.exists(filename):
+            os.unlink(filename)
+        raise
+    print "  Restored {0} chunks. SHA-1 checksum: {1}".format(len(manifest['chunks']), manifest['sha1'])
+
+
+
+def list_remote_keys(bucket, prefix):
+    '''
+    Fetch all remote keys below the prefix with a single (paged) LIST request.
+    The listed keys have their size, but no metadata.
+    '''
+
+    # boto drops the leading slash of our key names from the request path, so
+    # on S3 the keys do not have it
+    return dict(('/' + k.name, k) for k in bucket.list(prefix=prefix.lstrip('/')))
+
+
+
+def is_single_part(k):
+    '''
+    The ETag of a key that was uploaded in one piece is the MD5 checksum of its
+    data. A multipart upload has an ETag like '<md5 of the part MD5s>-<parts>'.
+    '''
+
+    return bool(k.etag) and '-' not in k.etag
+
+
+
+def get_remote_key(bucket, remote_keys, key_str, file_size):
+    '''
+    Look up the remote key including its metadata. With a listing of the remote
+    keys, only keys that can still be identical to the local file need a HEAD
+    request, and of those only the ones uploaded in several parts: for the
+    others, the listed ETag is enough to compare the file.
+    '''
+
+    if remote_keys is not None:
+        k = remote_keys.get(key_str)
+        if k is None or (file_size is not None and (k.size != file_size or is_single_part(k))):
+            return k
+    return bucket.get_key(key_str)
+
+
+
+def backup_file(bucket, remote_keys, filename, key_str, local_file_sha1, local_file_md5,
+                concurrency, host_name, known_chunks=None):
+    '''
+    Upload a single file, unless the same file is already in the Cloud. With a
+    set of known chunks, the file goes to the chunk store instead.
+    '''
+
+    file_size = os.path.getsize(filename)
+
+    print "-"*70
+    print "Backup to Amazon S3:", filename
+    print "-"*70
+
+    # Since multipart uploads do not support checksums, we have to generate our own
+    # and provide it as a meta tag. Then we can compare against that to check if
+    # the very same file is already uploaded. Simply use our own checksum regardless
+    # of upload type. The checksum has to be known before the upload starts, since
+    # S3 only takes metadata at the beginning of an upload.
+    print "\n* Local file checksum: ", local_file_sha1
+
+    print "\n* Checking if remote file exists:", key_str
+    if known_chunks is not None:
+        # The size of the chunk list says nothing about the file
+        k = get_remote_key(bucket, remote_keys, key_str, None)
+    else:
+        k = get_remote_key(bucket, remote_keys, key_str, file_size)
+
+    if k and known_chunks is None and is_single_part(k):
+        remote_file_md5 = k.etag.strip('"')
+        print "  File already exists. Remote MD5 checksum: {0}".format(remote_file_md5)
+        if (local_file_md5 == remote_file_md5):
+            print "  MD5 checksum identical. Skipping file transfer."
+            return
+    elif k:
+        remote_file_sha1 = k.get_metadata(_s3_sha1_meta_key)
+        print "  File already exists. Remote GWN checksum: {0}".format(remote_file_sha1)
+        if (local_file_sha1 == remote_file_sha1):
+            print "  SHA-1 checksum identical. Skipping file transfer."
+            return
+
+    print "\n* File transfer required. Determining transfer method."
+
+    if not k:
+        k = Key(bucket)
+        k.storage_class='STANDARD_IA'
+        k.key = key_str
+
+    meta = { _s3_sha1_meta_key : local_file_sha1 }
+
+    with open(filename, 'rb') as myfile:
+        if known_chunks is not None:
+            chunk_store_transfer(k, myfile, meta, host_name, known_chunks, concurrency)
+        elif file_size < _chunk_threshold_mb * 1024 * 1024:
+            try:
+                standard_transfer(k, myfile, meta)
+            except Exception as e:
+                raise TransferError("Standard upload failed", "Error: {0}".format(e))
+        else:
+            multipart_transfer(bucket, k, myfile, file_size, meta, concurrency)
+
+
+
+def backup_stream(bucket, stream, key_str, concurrency):
+    '''
+    Upload standard input, e.g. from a tee in the backup pipeline:
+
+        mysqldump ... | xz | gpg ... | tee FILE | backup_to_s3.py --stdin FILE
+
+    When the file itself is backed up later, its checksum matches and it is
+    not sent again.
+    '''
+
+    print "-"*70
+    print "Backup to Amazon S3: standard input as", key_str
+    print "-"*70
+
+    local_sha1 = stream_transfer(bucket, key_str, stream, concurrency)
+    print "\n* Stream checksum: ", local_sha1
+
+
 
 def main():
 
     global _s3_access_key
     global _s3_secret_key
     global _s3_bucket_name
+    global _s3_endpoint
+    global _chunk_size_mb
+    global _chunk_threshold_mb
+    global _state_dir
+    global _sha1_cache_file
 
-    usageStr = "Usage: %prog [options]"
+    usageStr = "Usage: %prog [options] [FILE...]"
     parser = OptionParser(usage=usageStr)
     
-    parser.add_option("-f", "--file", dest="filename",
-                  help="which file to back up in the Cloud", metavar="FILE")
+    parser.add_option("-f", "--file", dest="filenames", action="append", default=[],
+                  help="which file to back up in the Cloud (can be repeated)", metavar="FILE")
+    parser.add_option("-d", "--directory", dest="directory",
+                  help="back up all files in this directory", metavar="DIR")
     parser.add_option("-a", "--access-key", dest="s3_access_key",
                   help="the access key for the S3 bucket", metavar="STRING")
     parser.add_option("-s", "--secret-key", dest="s3_secret_key",
                   help="the secret key for the S3 bucket", metavar="STRING")
     parser.add_option("-b", "--bucket", dest="s3_bucket",
                   help="the name of the S3 bucket", metavar="STRING")
+    parser.add_option("-c", "--concurrency", dest="concurrency", type="int", default=_concurrency,
+                  help="how many chunks of a multipart upload to send in parallel", metavar="NUMBER")
+    parser.add_option("--stdin", dest="stdin_name",
+                  help="back up standard input under the name of this file", metavar="FILE")
+    parser.add_option("--chunk-store", dest="chunk_store", action="store_true", default=False,
+                  help="store the files as deduplicated chunks, only sending new chunks")
+    parser.add_option("--restore", dest="restore", action="store_true", default=False,
+                  help="restore the given files from the chunk store instead of backing them up")
+    parser.add_option("--endpoint", dest="endpoint",
+                  help="use this S3-compatible server instead of Amazon, e.g. for benchmarks",
+                  metavar="HOST:PORT")
+    parser.add_option("--chunk-size-mb", dest="chunk_size_mb", type="int", default=_chunk_size_mb,
+                  help="largest chunk size of multipart uploads", metavar="MB")
+    parser.add_option("--threshold-mb", dest="threshold_mb", type="int", default=_chunk_threshold_mb,
+                  help="files of this size and up are sent as multipart uploads", metavar="MB")
+    parser.add_option("--state-dir", dest="state_dir", default=_state_dir,
+                  help="where to keep upload manifests and the checksum cache", metavar="DIR")
+    parser.add_option("-l", "--limit", dest="limit",
+                  help="bandwidth limit in KB/s by hour of the day, e.g. '0-6:0,6-24:512' "
+                       "(0 or no entry means unlimited)", metavar="PROFILE")
 
     (options, args) = parser.parse_args()
     
-    if options.filename is None:
-        die("Option -f is required");
+    filenames = options.filenames + args
+    if options.directory is not None:
+        if not os.path.isdir(options.directory):
+            die("Given directory '" + options.directory + "' is not a directory.")
+        for name in sorted(os.listdir(options.directory)):
+            path = os.path.join(options.directory, name)
+            if os.path.isfile(path):
+                filenames.append(path)
+
+    if options.stdin_name is not None:
+        if filenames or options.chunk_store:
+            die("Option --stdin cannot be combined with files or --chunk-store")
+    elif not filenames:
+        die("Option -f, -d or --stdin is required");
+    if options.restore and not options.chunk_store:
+        die("Option --restore requires --chunk-store")
+    if options.limit:
+        try:
+            upload_limit.profile = parse_bandwidth_profile(options.limit)
+        except ValueError:
+            die("Invalid bandwidth profile '" + options.limit + "'")
     if options.s3_access_key is not None:
         _s3_access_key = options.s3_access_key
     if options.s3_secret_key is not None:
         _s3_secret_key = options.s3_secret_key
     if options.s3_bucket is not None:
         _s3_bucket_name = options.s3_bucket
+    _s3_endpoint = options.endpoint
+    _chunk_size_mb = max(options.chunk_size_mb, 1)
+    _chunk_threshold_mb = options.threshold_mb
+    if options.state_dir != _state_dir:
+        _state_dir = options.state_dir
+        _sha1_cache_file = os.path.join(_state_dir, 'sha1.cache')
 
     # Get my own full host name
     host_name = socket.getfqdn()
@@ -160,73 +1374,109 @@ def main():
     if not host_name or len(host_name)<1:
         die("Cannot determine full host name");
 
-    if not os.path.isfile(options.filename):
-        die("Given file '" + options.filename + "' is not a file.")
-        
-    basename = os.path.basename(options.filename)
-    file_size = os.path.getsize(options.filename)
-
-    print "-"*70
-    print "Backup to Amazon S3:", options.filename
-    print "-"*70
-    
+    for filename in filenames:
+        if options.restore and os.path.exists(filename):
+            die("Will not overwrite '" + filename + "' when restoring.")
+        if not options.restore and not os.path.isfile(filename):
+            die("Given file '" + filename + "' is not a file.")
         
     print "\n* Connecting to Cloud"
     try:
-        conn = boto.connect_s3(_s3_access_key, _s3_secret_key)
-        bucket = conn.get_bucket(_s3_bucket_name)
+        bucket = connect_bucket()
     except S3ResponseError as e:
         die("Unable to connect to Cloud", e)
-    
 
-    need_transfer = True
-    key_str = '/' + host_name + '/' + basename
-    k = bucket.get_key(key_str)
-    
-    with open(options.filename, 'rb') as myfile:
-    
-        # Since multipart uploads do not support checksums, we have to generate our own
-        # and provide it as a meta tag. Then we can compare against that to check if
-        # the very same file is already uploaded. Simply use our own checksum regardless
-        # of upload type.    
-        print "\n* Generating SHA-1 checksum of local file"
-        myfile.seek(0)
-        checksum = sha1()
-        buff = myfile.read(1024 * 1024)
-        while buff:
-            checksum.update(buff)
-            buff = myfile.read(1024 * 1024)
-        myfile.seek(0)
-        local_file_sha1 = checksum.hexdigest()
-        print "  Local file checksum: ", local_file_sha1
-
-        print "\n* Checking if remote file exists:", key_str
-        
-        if k:
-            remote_file_sha1 = k.get_metadata(_s3_sha1_meta_key)
-            print "  File already exists. Remote GWN checksum: {0}".format(remote_file_sha1)
-            if (local_file_sha1 == remote_file_sha1):
-                print "  SHA-1 checksum identical. Skipping file transfer."
-                need_transfer = False
-    
-                
-        if need_transfer:
-            print "\n* File transfer required. Determining transfer method."
-            
-            if not k:
-                k = Key(bucket)
-                k.storage_class='STANDARD_IA'
-                k.key = key_str
-                
-            meta = { _s3_sha1_meta_key : local_file_sha1 }
-
-            if file_size < _chunk_threshold_mb * 1024 * 1024:
-                standard_transfer(k, myfile, meta)
-            else:
-                multipart_transfer(bucket, k, myfile, file_size, meta)
-            
-        
+    if options.restore:
+        for filename in filenames:
+            key_str = '/' + host_name + '/' + os.path.basename(filename) + _chunk_store_suffix
+            try:
+                restore_from_chunk_store(bucket, filename, key_str, host_name)
+            except (TransferError, S3ResponseError, IOError) as e:
+                die("Unable to restore '" + filename + "'", e)
         print "All done.\n\n"
+        return
+
+    expire_manifests(bucket)
+
+    if upload_limit.profile:
+        rate = upload_limit.current_rate()
+        print "\n* Bandwidth limit for this hour:", get_human_readable(rate) + "/s" if rate else "none"
+
+    if options.stdin_name is not None:
+        key_str = '/' + host_name + '/' + os.path.basename(options.stdin_name)
+        try:
+            backup_stream(bucket, sys.stdin, key_str, max(options.concurrency, 1))
+        except TransferError as e:
+            die(str(e), e.details)
+        except S3ResponseError as e:
+            die("Unable to back up standard input", e)
+        except KeyboardInterrupt:
+            die("Interrupted")
+        print "All done.\n\n"
+        return
+
+    if not options.chunk_store:
+        listed = set(os.path.realpath(f) for f in filenames)
+        for path in get_pending_uploads():
+            if path not in listed:
+                print "\n* Resuming unfinished upload of", path
+                filenames.append(path)
+
+    # For more than one file, a single listing of the remote files is cheaper
+    # than asking for every file separately
+    basenames = [os.path.basename(f) for f in filenames]
+    if options.chunk_store:
+        basenames = [b + _chunk_store_suffix for b in basenames]
+    remote_keys = None
+    if len(filenames) > 1:
+        prefix = '/' + host_name + '/' + os.path.commonprefix(basenames)
+        print "\n* Listing remote files:", prefix
+        try:
+            remote_keys = list_remote_keys(bucket, prefix)
+        except S3ResponseError as e:
+            die("Unable to list remote files", e)
+
+    known_chunks = None
+    if options.chunk_store:
+        print "\n* Listing chunk store"
+        try:
+            known_chunks = set(list_remote_keys(bucket, get_chunk_key(host_name, '')).keys())
+        except S3ResponseError as e:
+            die("Unable to list chunk store", e)
+        print "  {0} chunks in the Cloud".format(len(known_chunks))
+
+    checksums = ChecksumThread(filenames)
+    checksums.start()
+
+    failures = 0
+    try:
+        for (filename, basename) in zip(filenames, basenames):
+            # Wait with a timeout, so Ctrl-C still reaches the main thread
+            while True:
+                try:
+                    ((local_file_sha1, local_file_md5), error) = checksums.results.get(True, 1)
+                    break
+                except Empty:
+                    pass
+            try:
+                if error is not None:
+                    raise TransferError("Unable to read '" + filename + "'", error)
+                backup_file(bucket, remote_keys, filename, '/' + host_name + '/' + basename,
+                            local_file_sha1, local_file_md5, max(options.concurrency, 1),
+                            host_name, known_chunks)
+            except TransferError as e:
+                report_error(str(e), e.details)
+                failures += 1
+            except S3ResponseError as e:
+                report_error("Unable to back up '" + filename + "'", e)
+                failures += 1
+    except KeyboardInterrupt:
+        die("Interrupted")
+
+    if failures > 0:
+        die("{0} of {1} files could not be backed up".format(failures, len(filenames)))
+
+    print "All done.\n\n"
 
 
 
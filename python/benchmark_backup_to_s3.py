@@ -0,0 +1,129 @@
+#!/usr/bin/python2
+'''
+Throughput benchmark for backup_to_s3.py. Runs the real script against the
+local S3 stub (s3_stub.py) with synthetic files, and compares standard,
+multipart and parallel multipart uploads at different chunk sizes. Reports
+throughput, CPU time and peak RSS of each run, to tune _chunk_size_mb,
+_chunk_threshold_mb and _concurrency from data instead of guesses.
+
+On loopback the uploads are CPU-bound. Use --latency-ms and --rate-kb to make
+every connection behave like a single stream to S3 from a facility.
+'''
+
+from optparse import OptionParser
+from subprocess import Popen, STDOUT
+from tempfile import TemporaryFile
+from time import time
+import os
+import sys
+
+from s3_stub import S3Stub
+
+
+_backup_script = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'backup_to_s3.py')
+
+
+
+def get_int_list(value):
+    return [int(v) for v in value.split(',') if v]
+
+
+
+def create_test_file(path, size_mb):
+    '''
+    Write a file of random (so incompressible, like the encrypted backups) data.
+    '''
+
+    if os.path.isfile(path) and os.path.getsize(path) == size_mb * 1024 * 1024:
+        return
+    print "* Creating {0} MB test file {1}".format(size_mb, path)
+    block = os.urandom(1024 * 1024)
+    with open(path, 'wb') as f:
+        for i in range(0, size_mb):
+            # Vary the blocks cheaply, so no chunk is a copy of another
+            f.write(os.urandom(16) + block[16:])
+
+
+
+def run_backup(server, options, path, args):
+    '''
+    Upload the file once with the given extra arguments. Returns wall time,
+    CPU time and peak RSS (KB) of the backup process.
+    '''
+
+    server.reset()
+    command = [sys.executable, _backup_script, '--endpoint', server.endpoint,
+               '--state-dir', os.path.join(options.work_dir, 'state')] + args + [path]
+
+    with TemporaryFile() as output:
+        start = time()
+        p = Popen(command, stdout=output, stderr=STDOUT)
+        (pid, status, usage) = os.wait4(p.pid, 0)
+        duration = time() - start
+
+        if status != 0 or server.bytes_received < os.path.getsize(path):
+            output.seek(0)
+            print output.read()[-4000:]
+            raise Exception("Backup run failed: " + ' '.join(command))
+
+    return (duration, usage.ru_utime + usage.ru_stime, usage.ru_maxrss)
+
+
+
+def main():
+
+    parser = OptionParser(usage="Usage: %prog [options]")
+    parser.add_option("-s", "--sizes-mb", dest="sizes", default="256,2048",
+                      help="comma separated sizes of the test files", metavar="LIST")
+    parser.add_option("-k", "--chunk-sizes-mb", dest="chunk_sizes", default="16,50,100",
+                      help="comma separated multipart chunk sizes to try", metavar="LIST")
+    parser.add_option("-c", "--concurrency", dest="concurrency", default="1,4,8",
+                      help="comma separated numbers of parallel chunk uploads to try", metavar="LIST")
+    parser.add_option("-d", "--work-dir", dest="work_dir", default="/var/tmp/backup-benchmark",
+                      help="where to put the test files", metavar="DIR")
+    parser.add_option("--latency-ms", dest="latency_ms", type="int", default=0,
+                      help="delay of the stub before answering each request", metavar="MS")
+    parser.add_option("--rate-kb", dest="rate_kb", type="int", default=0,
+                      help="bandwidth cap of the stub per connection in KB/s", metavar="KB")
+    (options, args) = parser.parse_args()
+
+    if not os.path.isdir(options.work_dir):
+        os.makedirs(options.work_dir)
+
+    server = S3Stub(latency=options.latency_ms / 1000.0, rate=options.rate_kb * 1024).start()
+    print "* S3 stub listening on", server.endpoint
+
+    results = []
+    for size_mb in get_int_list(options.sizes):
+        path = os.path.join(options.work_dir, 'benchmark-{0}MB.bin'.format(size_mb))
+        create_test_file(path, size_mb)
+
+        # Fills the page cache and the checksum cache, so that all measured
+        # runs only differ in how they upload
+        print "* Warming up with", path
+        run_backup(server, options, path, ['--threshold-mb', str(size_mb + 1)])
+
+        runs = [('standard', 0, 1, ['--threshold-mb', str(size_mb + 1)])]
+        for chunk_mb in get_int_list(options.chunk_sizes):
+            for concurrency in get_int_list(options.concurrency):
+                runs.append(('multipart' if concurrency == 1 else 'parallel', chunk_mb, concurrency,
+                             ['--threshold-mb', '0', '--chunk-size-mb', str(chunk_mb), '-c', str(concurrency)]))
+
+        for (mode, chunk_mb, concurrency, run_args) in runs:
+            (duration, cpu, rss) = run_backup(server, options, path, run_args)
+            results.append((size_mb, mode, chunk_mb, concurrency, duration, cpu, rss))
+            print "  {0:>10} chunk {1:>4} MB x {2:>2}: {3:7.1f} s".format(mode, chunk_mb or '-', concurrency, duration)
+
+    print
+    print "{0:>8} {1:>10} {2:>8} {3:>6} {4:>9} {5:>9} {6:>9} {7:>9}".format(
+        'File MB', 'Mode', 'Chunk MB', 'Conc', 'Seconds', 'MB/s', 'CPU s', 'RSS MB')
+    print "-" * 78
+    for (size_mb, mode, chunk_mb, concurrency, duration, cpu, rss) in results:
+        print "{0:>8} {1:>10} {2:>8} {3:>6} {4:>9.1f} {5:>9.1f} {6:>9.1f} {7:>9.1f}".format(
+            size_mb, mode, chunk_mb or '-', concurrency, duration, size_mb / max(duration, 0.001),
+            cpu, rss / 1024.0)
+
+
+
+if __name__ == '__main__':
+    main()
@@ -14,21 +14,39 @@ from base64 import b64decode
 from Crypto.Cipher import AES
 from fcntl import lockf, LOCK_EX, LOCK_NB
 from hashlib import sha1
-from json import loads
+from json import loads, dump
+from multiprocessing.pool import ThreadPool
 from os.path import exists, getsize, join, isfile, islink, realpath
-from os import unlink, listdir, makedirs, symlink, getpid
+from os import unlink, listdir, makedirs, symlink, getpid, rename, stat
+from Queue import Queue
 from re import search, sub
 from subprocess import check_call
 from urllib2 import ProxyHandler, build_opener, HTTPError, URLError
 from urlparse import urlparse
 from shutil import rmtree
 from socket import getfqdn
+from threading import Thread, Lock
+from time import time, sleep
 from traceback import print_exc
 
 
 # Constants
 encryption_key = b64decode('AB59EA0D21EA8C73918FD41F860EAE49')
 
+# Blocks of 4 MB that may wait between two stages of the download pipeline
+pipeline_depth = 4
+
+# Seconds to wait for a peer on the LAN, before trying the next one
+peer_timeout = 5
+
+# Checksums of the plain images by path, inode, size and mtime. Lives in the
+# local repo, and spares re-reading unchanged images on every run.
+checksum_index_name = '.checksums.json'
+
+# The manifest of the last run with its ETag and Last-Modified headers, so it
+# is only downloaded again when it changed
+manifest_cache_name = '.manifest-cache.json'
+
 # Set up the logger
 logging.basicConfig(format='%(asctime)s [%(levelname)-8s] %(message)s')
 logger = logging.getLogger()
@@ -52,6 +70,16 @@ parser.add_argument('--mount-locally', action='store_true', default=False,
 parser.add_argument('--purge-local', action='store_true', default=False,
                     help='DANGEROUS! If set, all files not in the manifest will be deleted from '
                          'the local directory specified in --local-repo.')
+parser.add_argument('--parallel', metavar='NUMBER', type=int, default=2,
+                    help='How many images to download at the same time (default: 2)')
+parser.add_argument('--limit-kb', metavar='KB', type=int, default=0,
+                    help='Limit the total download bandwidth to this many KB/s (default: unlimited)')
+parser.add_argument('--peer', metavar='URL', type=str, action='append', default=[],
+                    help='Base URL of the local repo of another server on the LAN. Images are copied '
+                         'from there if it has them, before trying the remote repository (can be repeated)')
+parser.add_argument('--deep-verify', action='store_true', default=False,
+                    help='Re-read all local images to verify their checksums, even if the checksum '
+                         'index says they are unchanged')
 parser.add_argument('--debug', action='store_true',
                     help='Turn on detailed logging')
 
@@ -82,13 +110,16 @@ except IOError as io:
     exit(1)
 
 
-def open_url_connection(url, proxy=None, headers=None):
+def open_url_connection(url, proxy=None, headers=None, direct=False, timeout=120):
     if not headers:
         headers = {}
     if proxy is not None:
         logger.debug('  Using the following proxy: {0}'.format(proxy))
         proxy_handler = ProxyHandler({'http': proxy, 'https': proxy})
         url_opener = build_opener(proxy_handler)
+    elif direct:
+        # Not even the proxy from the environment (http_proxy)
+        url_opener = build_opener(ProxyHandler({}))
     else:
         url_opener = build_opener()
 
@@ -98,21 +129,114 @@ def open_url_connection(url, proxy=None, headers=None):
         url_opener.addheaders.append((k, headers[k]))
 
     logger.debug('  Sending these HTTP headers: {0}'.format(url_opener.addheaders))
-    connection = url_opener.open(url, timeout=120)
+    connection = url_opener.open(url, timeout=timeout)
     if 'X-Cache' in connection.headers:
         logger.debug('  X-Cache response: {0}'.format(connection.headers['X-Cache']))
     return connection
 
 
-def download_file(args, img):
+class TokenBucket(object):
+    """
+    Bandwidth limit shared by all downloads, in bytes per second (0 means
+    unlimited). Unused bandwidth is saved up for at most a second.
+    """
+    def __init__(self, rate):
+        self.rate = rate
+        self.tokens = 0.0
+        self.last = time()
+        self.lock = Lock()
+
+    def consume(self, size):
+        if not self.rate:
+            return
+        # The tokens may go into debt. The caller then waits until it is paid off.
+        with self.lock:
+            now = time()
+            self.tokens = min(self.tokens + (now - self.last) * self.rate, float(self.rate))
+            self.last = now
+            self.tokens -= size
+            wait = -self.tokens / self.rate
+        if wait > 0:
+            sleep(wait)
+
+
+class PipelineStage(Thread):
+    """
+    One stage of the download pipeline. Takes blocks from its input queue, passes
+    them to the work function and hands the result on to the next stage. A None
+    block marks the end of the data. After an error, the remaining blocks are
+    still consumed, so the earlier stages never block on a full queue.
+    """
+    def __init__(self, name, work, next_stage=None):
+        Thread.__init__(self, name=name)
+        self.daemon = True
+        self.input = Queue(maxsize=pipeline_depth)
+        self.work = work
+        self.next_stage = next_stage
+        self.error = None
+
+    def run(self):
+        while True:
+            block = self.input.get()
+            if block is None:
+                break
+            if self.error is not None:
+                continue
+            try:
+                result = self.work(block)
+                if self.next_stage is not None:
+                    self.next_stage.input.put(result)
+            except Exception as e:
+                self.error = e
+        if self.next_stage is not None:
+            self.next_stage.input.put(None)
+
+
+class StreamDecryptor(object):
+    """
+    AES-CFB decryption of an encrypted image that arrives in blocks of any size.
+    The first <AES.block_size> bytes of the image are the IV.
+    """
+    def __init__(self):
+        self.iv = b''
+        self.cipher = None
+
+    def decrypt(self, block):
+        if self.cipher is None:
+            missing = AES.block_size - len(self.iv)
+            self.iv += block[:missing]
+            block = block[missing:]
+            if len(self.iv) < AES.block_size:
+                return b''
+            self.cipher = AES.new(encryption_key, AES.MODE_CFB, self.iv)
+        return self.cipher.decrypt(block)
+
+
+def download_file(args, img, local_plain_file):
     """
     Download the encrypted file into a temp file. Resume if a partial temp
-    file was found. If the checksum does not match in the end, discard the
-    file and abort, so it can try again later.
+    file was found. The data runs through a pipeline of threads that checksums
+    the encrypted data, decrypts it and checksums and writes the plain data,
+    while the download goes on. The plain file is only put in place once both
+    checksums match. Otherwise, it is discarded and we abort, so it can try again
+    later.
 
     :return: True if the download was successful, False if there was a problem
     """
     local_temp_crypt_file = '{0}/{1}.part'.format(args.local_repo, img)
+    local_temp_plain_file = '{0}.tmp'.format(local_plain_file)
+
+    # A server on the LAN may already have the image
+    if args.peer and download_from_peers(args, img, local_plain_file):
+        return True
+
+    # With a block map, only the blocks that changed since an older local image
+    # need to be downloaded. An interrupted full download is resumed instead.
+    if not exists(local_temp_crypt_file) and 'blockMap' in manifest['images'][img]:
+        if download_delta(args, img, local_plain_file):
+            return True
+        logger.debug('  Falling back to downloading the full image.')
+
     if exists(local_temp_crypt_file):
         existing_size = getsize(local_temp_crypt_file)
         headers = {'Range': 'bytes={0}-'.format(existing_size)}
@@ -121,60 +245,98 @@ def download_file(args, img):
         existing_size = 0
         headers = {}
 
-    # Skip the download if the file is already completely downloaded
-    if not exists(local_temp_crypt_file) or getsize(local_temp_crypt_file) < manifest['images'][img]['size']:
-        total_downloaded = existing_size
-        with io.open(local_temp_crypt_file, 'ab') as writer:
-            resp = open_url_connection('{0}/{1}'.format(args.repo_base, img),
-                                       proxy=args.proxy, headers=headers)
+    crypt_sha1 = sha1()
+    plain_sha1 = sha1()
+    decryptor = StreamDecryptor()
 
-            while True:
-                block = resp.read(2**22)
-                if not block:
-                    break
-                total_downloaded += len(block)
-                writer.write(block)
-                logger.debug('    Saved %.2f%% of the file',
-                             (100. * total_downloaded / manifest['images'][img]['size']))
-    else:
-        logger.debug('  Downloaded file already complete in local repo.')
+    try:
+        with io.open(local_temp_plain_file, 'wb') as plain:
+            def hash_crypt(block):
+                crypt_sha1.update(block)
+                return block
+
+            def write_plain(block):
+                plain_sha1.update(block)
+                plain.write(block)
+
+            write_stage = PipelineStage('write', write_plain)
+            decrypt_stage = PipelineStage('decrypt', decryptor.decrypt, write_stage)
+            hash_stage = PipelineStage('hash', hash_crypt, decrypt_stage)
+            stages = [hash_stage, decrypt_stage, write_stage]
+            for stage in stages:
+                stage.start()
+
+            def pipeline_failed():
+                return any(stage.error is not None for stage in stages)
+
+            try:
+                # The partial download has to go through the pipeline first
+                if existing_size > 0:
+                    logger.debug('  Feeding the partial download into the pipeline.')
+                    with io.open(local_temp_crypt_file, 'rb') as crypt:
+                        while True:
+                            block = crypt.read(2**22)
+                            if not block or pipeline_failed():
+                                break
+                            hash_stage.input.put(block)
+
+                # Skip the download if the file is already completely downloaded
+                if existing_size < manifest['images'][img]['size']:
+                    total_downloaded = existing_size
+                    with io.open(local_temp_crypt_file, 'ab') as writer:
+                        resp = open_url_connection('{0}/{1}'.format(args.repo_base, img),
+                                                   proxy=args.proxy, headers=headers)
+
+                        while True:
+                            # No point in downloading the rest once a stage gave up
+                            if pipeline_failed():
+                                break
+                            block = resp.read(2**22)
+                            if not block:
+                                break
+                            download_limit.consume(len(block))
+                            total_downloaded += len(block)
+                            writer.write(block)
+                            hash_stage.input.put(block)
+                            logger.debug('    Saved %.2f%% of %s',
+                                         (100. * total_downloaded / manifest['images'][img]['size']), img)
+                else:
+                    logger.debug('  Downloaded file already complete in local repo.')
+            finally:
+                hash_stage.input.put(None)
+                for stage in stages:
+                    stage.join()
+    except Exception:
+        # Do not leave a half written image behind
+        try:
+            unlink(local_temp_plain_file)
+        except OSError:
+            pass
+        raise
+
+    for stage in stages:
+        if stage.error is not None:
+            logger.error('  Processing the download failed in the {0} stage.'.format(stage.name))
+            unlink(local_temp_plain_file)
+            raise stage.error
 
     # Verify the checksum of the downloaded file
-    logger.debug('  Checking encrypted file\'s checksum...')
-    local_temp_crypt_sha1 = get_file_checksum(local_temp_crypt_file)
-    if local_temp_crypt_sha1 != manifest['images'][img]['cryptSha1']:
+    if crypt_sha1.hexdigest() != manifest['images'][img]['cryptSha1']:
         logger.error('  Checksum of downloaded encrypted file does not match manifest. Discarding.')
         unlink(local_temp_crypt_file)
+        unlink(local_temp_plain_file)
         return False
 
-    # Checksum matches. Decrypt the encrypted file.
-    logger.debug('  Checksum of encrypted file is correct. Decrypting '
-                 'temporary file {0}'.format(local_temp_crypt_file))
-    crypt_size = getsize(local_temp_crypt_file)
-    decrypted_bytes = 0
-    with io.open(local_plain_file, 'wb') as plain:
-        with io.open(local_temp_crypt_file, 'rb') as crypt:
-            # The first <AES.block_size> bytes are the IV
-            iv = crypt.read(AES.block_size)
-            cipher = AES.new(encryption_key, AES.MODE_CFB, iv)
-            while True:
-                block = crypt.read(2**22)
-                if not block:
-                    break
-                p = cipher.decrypt(block)
-                plain.write(p)
-                decrypted_bytes += len(p)
-                logger.debug('    Decrypted %.2f%% of the file', (100. * decrypted_bytes / crypt_size))
-
     # Verify checksum of plain file
-    logger.debug('  Checking plain file\'s checksum...')
-    local_plain_sha1 = get_file_checksum(local_plain_file)
-    if local_plain_sha1 != manifest['images'][img]['plainSha1']:
+    if plain_sha1.hexdigest() != manifest['images'][img]['plainSha1']:
         logger.error('  Checksum of decrypted image file does not match manifest. Discarding.')
-        unlink(local_plain_file)
+        unlink(local_temp_plain_file)
         return False
     else:
-        logger.debug('  Checksum of decrypted image is correct.')
+        logger.debug('  Checksums of encrypted file and decrypted image are correct.')
+
+    # Replace the plain file in one go, a mounted old image keeps its data
+    rename(local_temp_plain_file, local_plain_file)
 
     # The plain file is correct. We can discard the temporary, encrypted file
     logger.debug('  Removing temporary encrypted file: {0}'.format(local_temp_crypt_file))
@@ -182,6 +344,194 @@ def download_file(args, img):
     return True
 
 
+def download_from_peers(args, img, local_plain_file):
+    """
+    Copy the plain image from the first server on the LAN that has it (--peer),
+    so the uplink of the site carries each image only once. The copy is checked
+    against plainSha1 like any download. Peers are asked directly, not through
+    the proxy.
+
+    :return: True if the image was copied from a peer, False to get it from the repository
+    """
+    image = manifest['images'][img]
+    local_temp_plain_file = '{0}.tmp'.format(local_plain_file)
+    for peer in args.peer:
+        url = '{0}/{1}'.format(peer.rstrip('/'), image['plainFileName'])
+        logger.debug('  Trying to copy the image from peer: {0}'.format(url))
+        try:
+            resp = open_url_connection(url, direct=True, timeout=peer_timeout)
+            # Do not copy a different version of the image just to discard it
+            if int(resp.headers.get('Content-Length', -1)) not in [-1, image['size'] - AES.block_size]:
+                logger.debug('  Peer has a different version of the image.')
+                continue
+
+            plain_sha1 = sha1()
+            with io.open(local_temp_plain_file, 'wb') as plain:
+                while True:
+                    block = resp.read(2**22)
+                    if not block:
+                        break
+                    plain_sha1.update(block)
+                    plain.write(block)
+
+            if plain_sha1.hexdigest() == image['plainSha1']:
+                logger.debug('  Checksum of the image from the peer is correct.')
+                rename(local_temp_plain_file, local_plain_file)
+                return True
+            logger.debug('  Checksum of the image from the peer does not match manifest. Discarding.')
+        except HTTPError as h:
+            logger.debug('  Peer does not have the image: code={0}'.format(h.code))
+        except Exception as e:
+            logger.debug('  Unable to copy the image from the peer: {0}'.format(e))
+        if exists(local_temp_plain_file):
+            unlink(local_temp_plain_file)
+
+    logger.debug('  No peer has the image.')
+    return False
+
+
+def get_delta_base(img, local_plain_file):
+    """
+    Find the older local image to take unchanged blocks from: the previous
+    version of the same file, or the image named by 'deltaBase' in the manifest.
+
+    :return: The path of the older image, or None if there is none
+    """
+    candidates = [local_plain_file]
+    if 'deltaBase' in manifest['images'][img]:
+        candidates.append(join(args.local_repo, manifest['images'][img]['deltaBase']))
+    for candidate in candidates:
+        if isfile(candidate):
+            return candidate
+    return None
+
+
+def download_plain_range(args, img, start, end, plain, plain_sha1):
+    """
+    Download and decrypt the plain bytes [start, end) of an image, and append
+    them to the plain file. AES-CFB decryption only depends on the preceding
+    <AES.block_size> bytes of encrypted data, so the request starts that much
+    earlier and these bytes serve as the IV. The file header is the IV of the
+    first block, so plain byte N is encrypted byte N + <AES.block_size>.
+    """
+    headers = {'Range': 'bytes={0}-{1}'.format(start, end + AES.block_size - 1)}
+    resp = open_url_connection('{0}/{1}'.format(args.repo_base, img), proxy=args.proxy, headers=headers)
+    if resp.getcode() != 206 or not resp.headers.get('Content-Range', '').startswith('bytes {0}-'.format(start)):
+        raise Exception('Repository does not support range requests')
+
+    iv = resp.read(AES.block_size)
+    download_limit.consume(len(iv))
+    if len(iv) < AES.block_size:
+        raise Exception('Range response ended early')
+    cipher = AES.new(encryption_key, AES.MODE_CFB, iv)
+    remaining = end - start
+    while remaining > 0:
+        block = resp.read(min(2**22, remaining))
+        if not block:
+            raise Exception('Range response ended early')
+        download_limit.consume(len(block))
+        p = cipher.decrypt(block)
+        plain_sha1.update(p)
+        plain.write(p)
+        remaining -= len(block)
+
+
+def download_delta(args, img, local_plain_file):
+    """
+    Build the new image from the unchanged blocks of an older local image, and
+    download only the changed blocks. The manifest names a block map in the
+    repository, with the block size and the SHA-1 of every plain block of the
+    image. Blocks are matched at the same alignment only, a rolling checksum
+    over every offset of a multi-GB image is too slow in Python.
+
+    :return: True if the image was built and verified, False to fall back to a full download
+    """
+    image = manifest['images'][img]
+    base_file = get_delta_base(img, local_plain_file)
+    if base_file is None:
+        logger.debug('  No older local image to take unchanged blocks from.')
+        return False
+
+    local_temp_plain_file = '{0}.tmp'.format(local_plain_file)
+    try:
+        resp = open_url_connection('{0}/{1}'.format(args.repo_base, image['blockMap']), proxy=args.proxy)
+        block_map = loads(resp.read())
+        block_size = block_map['blockSize']
+        block_sha1s = block_map['sha1']
+        plain_size = image['size'] - AES.block_size
+        if len(block_sha1s) != (plain_size + block_size - 1) / block_size:
+            raise Exception('Block map does not match the image size')
+
+        # Where the blocks of the older image are
+        base_blocks = {}
+        with io.open(base_file, 'rb') as base:
+            offset = 0
+            while True:
+                block = base.read(block_size)
+                if not block:
+                    break
+                base_blocks.setdefault(sha1(block).hexdigest(), offset)
+                offset += len(block)
+
+        changed = len([s for s in block_sha1s if s not in base_blocks])
+        logger.debug('  {0} of {1} blocks changed since {2}.'.format(changed, len(block_sha1s), base_file))
+        if changed == len(block_sha1s):
+            return False
+
+        plain_sha1 = sha1()
+        with io.open(base_file, 'rb') as base, io.open(local_temp_plain_file, 'wb') as plain:
+            i = 0
+            while i < len(block_sha1s):
+                if block_sha1s[i] in base_blocks:
+                    base.seek(base_blocks[block_sha1s[i]])
+                    block = base.read(block_size)
+                    plain_sha1.update(block)
+                    plain.write(block)
+                    i += 1
+                else:
+                    # Fetch a run of changed blocks with a single request
+                    end = i
+                    while end < len(block_sha1s) and block_sha1s[end] not in base_blocks:
+                        end += 1
+                    download_plain_range(args, img, i * block_size, min(end * block_size, plain_size),
+                                         plain, plain_sha1)
+                    i = end
+
+        if plain_sha1.hexdigest() != image['plainSha1']:
+            logger.error('  Checksum of the image built from blocks does not match manifest. Discarding.')
+            unlink(local_temp_plain_file)
+            return False
+    except Exception as e:
+        logger.error('  Downloading the changed blocks of {0} failed: {1}'.format(img, e))
+        if exists(local_temp_plain_file):
+            unlink(local_temp_plain_file)
+        return False
+
+    logger.debug('  Checksum of the image built from blocks is correct.')
+    rename(local_temp_plain_file, local_plain_file)
+    return True
+
+
+def download_image(download):
+    """
+    Download one image in a worker thread of the download pool. An error only
+    affects this image, the other downloads go on.
+
+    :return: True if the download was successful, False if there was a problem
+    """
+    (img, local_plain_file) = download
+    logger.debug('Downloading image {0} to {1}'.format(img, local_plain_file))
+    try:
+        return download_file(args, img, local_plain_file)
+    except HTTPError as h:
+        logger.error('HTTPError downloading {0}: code={1}, info={2}'.format(img, h.code, h.info()))
+    except URLError as u:
+        logger.error('Unable to download {0} from the remote repository: {1}'.format(img, u.reason))
+    except Exception as e:
+        logger.error('Downloading {0} failed unexpectedly: {1}'.format(img, e))
+    return False
+
+
 def get_file_checksum(file_name):
     file_sha1 = sha1()
     with io.open(file_name, 'rb') as check:
@@ -193,6 +543,108 @@ def get_file_checksum(file_name):
     return file_sha1.hexdigest()
 
 
+def get_file_signature(file_name):
+    """
+    The inode, size and modification time (in ns) of a file. If these did not
+    change, neither did the content.
+    """
+    st = stat(file_name)
+    return [st.st_ino, st.st_size, int(st.st_mtime * 10**9)]
+
+
+def load_checksum_index(local_repo):
+    """
+    Load the checksum index of the local repo. A missing or broken index is
+    simply empty, and costs one full checksum run.
+    """
+    try:
+        with io.open(join(local_repo, checksum_index_name), 'rb') as index_file:
+            return loads(index_file.read())
+    except (IOError, ValueError) as e:
+        logger.debug('No usable checksum index: {0}'.format(e))
+        return {}
+
+
+def save_checksum_index(local_repo, index):
+    """
+    Save the checksum index of the local repo, without the entries of files
+    that are gone.
+    """
+    for file_name in index.keys():
+        if not exists(file_name):
+            del index[file_name]
+    save_local_state(local_repo, checksum_index_name, index)
+
+
+def save_local_state(local_repo, name, state):
+    """
+    Replace one of our own files in the local repo in one go. Failing to save
+    it only costs time on the next run.
+    """
+    state_file_name = join(local_repo, name)
+    try:
+        with open(state_file_name + '.tmp', 'wb') as state_file:
+            dump(state, state_file)
+        rename(state_file_name + '.tmp', state_file_name)
+    except (IOError, OSError) as e:
+        logger.error('Unable to save {0}: {1}'.format(state_file_name, e))
+
+
+def fetch_manifest(manifest_url):
+    """
+    Fetch the manifest, conditionally if we have a copy from the last run. On a
+    304 response, the copy is used again.
+
+    :return: The parsed manifest
+    """
+    cache = None
+    headers = {}
+    try:
+        with io.open(join(args.local_repo, manifest_cache_name), 'rb') as cache_file:
+            cache = loads(cache_file.read())
+        if cache['url'] != manifest_url:
+            cache = None
+        else:
+            if cache['etag']:
+                headers['If-None-Match'] = cache['etag']
+            if cache['last_modified']:
+                headers['If-Modified-Since'] = cache['last_modified']
+    except (IOError, ValueError, KeyError) as e:
+        logger.debug('No usable copy of the manifest: {0}'.format(e))
+        cache = None
+
+    try:
+        conn = open_url_connection(manifest_url, proxy=args.proxy, headers=headers)
+    except HTTPError as h:
+        if h.code == 304 and cache is not None:
+            logger.debug('  Manifest not modified since the last run. Using the local copy.')
+            return loads(cache['body'])
+        raise
+
+    data = conn.read()
+    manifest = loads(data)
+    if 'ETag' in conn.headers or 'Last-Modified' in conn.headers:
+        save_local_state(args.local_repo, manifest_cache_name,
+                         {'url': manifest_url, 'etag': conn.headers.get('ETag'),
+                          'last_modified': conn.headers.get('Last-Modified'), 'body': data})
+    return manifest
+
+
+def get_indexed_checksum(file_name):
+    """
+    Look up the checksum of a local image in the checksum index, and only read
+    the file if it changed since (or --deep-verify is set).
+    """
+    signature = get_file_signature(file_name)
+    entry = checksum_index.get(file_name)
+    if entry is not None and entry['signature'] == signature and not args.deep_verify:
+        logger.debug('  File unchanged since it was last verified.')
+        return entry['sha1']
+    file_sha1 = get_file_checksum(file_name)
+    checksum_index[file_name] = {'signature': signature, 'sha1': file_sha1}
+    return file_sha1
+
+
 def is_loop_mounted(mount_target):
     # Need to convert to real path in case they are symlinked elsewhere (PLATSUP-20660)
     real_path = realpath(mount_target)
@@ -268,13 +720,17 @@ try:
     # Fetch the manifest file
     manifest_url = '{0}://{1}{2}'.format(m.scheme, m.netloc, m.path)
     logger.debug('Fetching manifest file: {0}'.format(manifest_url))
-    conn = open_url_connection(manifest_url, proxy=args.proxy)
-    data = conn.read()
-    manifest = loads(data)
+    manifest = fetch_manifest(manifest_url)
 
     # Capture all files in the local repo, so we can later delete obsolete images
     local_files = listdir(args.local_repo)
+    for name in [checksum_index_name, manifest_cache_name]:
+        for f in [name, name + '.tmp']:
+            if f in local_files:
+                local_files.remove(f)
+    checksum_index = load_checksum_index(args.local_repo)
     required_mounts = []
+    wanted_images = []
 
     # Iterate over the images of the manifest and check which ones we need to download
     logger.debug('Processing image manifest')
@@ -308,7 +764,7 @@ try:
         download_required = False
         if exists(local_plain_file):
             logger.debug('  Local file present. Checking content against checksum.')
-            local_sha1 = get_file_checksum(local_plain_file)
+            local_sha1 = get_indexed_checksum(local_plain_file)
             logger.debug('  Local file SHA1: {0}'.format(local_sha1))
             if local_sha1 != manifest['images'][img]['plainSha1']:
                 logger.debug('  Does not match expected plain checksum. Download required.')
@@ -319,10 +775,24 @@ try:
             logger.debug('  Plain file not in local repo yet. Download required.')
             download_required = True
 
+        wanted_images.append((img, local_plain_file, download_required))
+
+    # Download the missing images, several at a time
+    downloads = [(img, local_plain_file) for (img, local_plain_file, required) in wanted_images if required]
+    download_limit = TokenBucket(args.limit_kb * 1024)
+    download_results = {}
+    if downloads:
+        logger.debug('Downloading {0} images, {1} at a time'.format(len(downloads), args.parallel))
+        pool = ThreadPool(max(min(args.parallel, len(downloads)), 1))
+        download_results = dict(zip([d[0] for d in downloads], pool.map(download_image, downloads)))
+        pool.close()
+
+    for (img, local_plain_file, download_required) in wanted_images:
         if download_required:
-            success = download_file(args, img)
-            if not success:
+            if not download_results[img]:
                 continue
+            checksum_index[local_plain_file] = {'signature': get_file_signature(local_plain_file),
+                                                'sha1': manifest['images'][img]['plainSha1']}
 
         # Remove the file from the list (if it is in there; just downloaded files are not in the list)
         if manifest['images'][img]['plainFileName'] in local_files:
@@ -381,6 +851,8 @@ try:
         else:
             logger.debug('  No --mount-locally set or no SquashFS image detected. Skipping auto-mount.')
 
+    save_checksum_index(args.local_repo, checksum_index)
+
     # Unmount all active mounts that are no longer supposed to be mounted
     if args.mount_locally:
         active_mounts = get_loop_mounts(args.local_repo)
@@ -15,6 +15,14 @@ import os
 import logging
 import operator
 import time
+import json
+import hashlib
+import heapq
+import multiprocessing
+import mmap
+import signal
+import subprocess
+from collections import OrderedDict
 from optparse import OptionParser
 from datetime import datetime, timedelta
 
@@ -47,6 +55,22 @@ warningRegex = {
 # Pattern that matches any exception; for calculating the "exceptions per hour" (EPH)
 anyException = re.compile('(([\w\$]+\.)+[A-Z][\w\$]*(Exception|Error|Failure))[^\w]')
 
+# Every line that one of the patterns above can match contains at least one of
+# these literals. Keep this in sync when adding patterns! Most log lines contain
+# none of them and are rejected with a few substring tests, before any of the far
+# more expensive regular expressions has to run.
+candidateLiterals = ('Exception', 'Error', 'Failure', 'exception', 'JmsEventReceiver',
+                     'Curriculum', 'Unable to')
+
+def isCandidate(logLine):
+    for literal in candidateLiterals:
+        if literal in logLine:
+            return True
+    return False
+
+# The same literals, for searching memory-mapped log files without splitting them into lines
+candidateRegex = re.compile('|'.join(re.escape(l) for l in candidateLiterals))
+
 
 
 # ----------------------------------------------------------------------------
@@ -57,32 +81,135 @@ logRoot = '/opt/logs'
 logName = 'server.log'
 scanWindowHours = 24
 
+# Checkpoint of the previous run, so that only newly appended log lines are parsed.
+# One per user: /var/tmp is sticky, so nagios could not replace a file of root's.
+stateFile = '/var/tmp/parse_jboss_log.{0}.state'.format(os.getuid())
+stateVersion = 2
+
+# Log lines start with a timestamp; the first 13 characters identify the hour
+logTimePattern = '^([0-9]{4}-[0-9]{2}-[0-9]{2} [0-9]{2}:[0-9]{2}:[0-9]{2}),'
+logTimeRegex = re.compile(logTimePattern)
+mappedTimeRegex = re.compile(logTimePattern[1:])
+logTimeFormat = '%Y-%m-%d %H:%M:%S'
+bucketTimeFormat = '%Y-%m-%d %H'
+
+# Rotated logs may be kept compressed; they are streamed through these decompressors
+decompressors = {
+                 '.gz' : ['gzip', '-dc'],
+                 '.xz' : ['xz', '-dc']
+}
+
+# Stack traces are clustered by a fingerprint of their exception and top frames. Only
+# the most recently seen fingerprints are kept, so runaway logs cannot eat up the memory.
+traceFrames = 5
+traceCapacity = 1000
+tracePrefix = '\tat '
+
+# Maximum number of distinct exception classes counted per hour for the EPH
+topCapacity = 1000
+
+# With parallel scans, files are split into shards of at least this many bytes
+minShardBytes = 16 * 1024 * 1024
+
 
 # ----------------------------------------------------------------------------
-# Find the first log line that is within the scan window 
+# Find the first timestamped log line that starts at or after the given byte
+# offset. Returns the offset of that line and its timestamp, or (None, None)
+# if there is none.
 # ----------------------------------------------------------------------------
 
-def findFirstLine(logger, logFile, scanWindowStart, logTimePattern):
-    
-    skippedLines = 0
+def findNextTimestamp(logFile, offset):
+
+    # Resynchronise to the start of the next line, unless we already are at one
+    if (offset > 0):
+        logFile.seek(offset - 1)
+        logFile.readline()
+    else:
+        logFile.seek(0)
+
+    while True:
+        lineStart = logFile.tell()
+        line = logFile.readline()
+        if not line.endswith('\n'):
+            return (None, None)
+
+        m = logTimeRegex.match(line)
+        if (m):
+            return (lineStart, datetime.strptime(m.group(1), logTimeFormat))
+
+
+# ----------------------------------------------------------------------------
+# Find the first log line that is within the scan window. The log is ordered
+# by time, so bisect over the byte offsets instead of reading it line by line.
+# Leaves the log file positioned at the start of that line.
+# ----------------------------------------------------------------------------
+
+def findFirstLine(logger, logFile, scanWindowStart):
+
+    low = 0
+    high = os.fstat(logFile.fileno()).st_size
+    seeks = 0
+
+    while (low < high):
+        middle = (low + high) // 2
+        (lineStart, lineDate) = findNextTimestamp(logFile, middle)
+        seeks += 1
+        if (lineDate is None or lineDate >= scanWindowStart):
+            high = middle
+        else:
+            low = middle + 1
+
+    (lineStart, lineDate) = findNextTimestamp(logFile, low)
+    logger.debug("    Bisected the file with " + str(seeks) + " seeks.")
+
+    if (lineDate is None):
+        logger.debug("All lines scanned and nothing was found.")
+        return None
+
+    logger.debug("    Found first log entry within scan window at offset " + str(lineStart) + ": " + str(lineDate))
+    logFile.seek(lineStart)
+    return lineDate
+
+
+# ----------------------------------------------------------------------------
+# Compressed logs cannot be bisected, so find the scan window start the slow
+# way. Timestamps compare correctly as strings, which saves the strptime() for
+# all the lines before the scan window. Returns the timestamp of the first line
+# within the window and its offset in the decompressed stream.
+# ----------------------------------------------------------------------------
+
+def findFirstStreamedLine(logger, logFile, scanWindowStart):
+
+    windowStart = scanWindowStart.strftime(logTimeFormat)
+    offset = 0
     for line in logFile:
-        m = re.search(logTimePattern, line)
-        if(m):
-            lineDate = datetime.strptime(m.group(1), "%Y-%m-%d %H:%M:%S")
-            if (lineDate < scanWindowStart):
-                #logger.debug("   " + str(lineDate) + " < " + str(scanWindowStart))
-                continue
-            else:
-                logger.debug("    Skipped " + str(skippedLines) + " lines in this file.")
-                logger.debug("    Found first log entry within scan window: " + str(lineDate))
-                return lineDate
+        m = logTimeRegex.match(line)
+        if (m and m.group(1) >= windowStart):
+            lineDate = datetime.strptime(m.group(1), logTimeFormat)
+            logger.debug("    Found first log entry within scan window at offset " + str(offset) + ": " + str(lineDate))
+            return (lineDate, offset)
+        offset += len(line)
 
-        skippedLines += 1
-        if (skippedLines%5000 == 0):
-            logger.debug("    Skipped " + str(skippedLines) + " lines so far...")
-            
     logger.debug("All lines scanned and nothing was found.")
-            
+    return (None, None)
+
+
+# ----------------------------------------------------------------------------
+# Compressed log files
+# ----------------------------------------------------------------------------
+
+def isCompressed(logFileName):
+    return os.path.splitext(logFileName)[1] in decompressors
+
+
+def openCompressedLog(logFileName):
+
+    # Python ignores SIGPIPE, which the decompressor would inherit. Restore it,
+    # so that closing the pipe early quietly ends the decompressor.
+    command = decompressors[os.path.splitext(logFileName)[1]] + [logFileName]
+    return subprocess.Popen(command, stdout=subprocess.PIPE,
+                            preexec_fn=lambda: signal.signal(signal.SIGPIPE, signal.SIG_DFL))
+
 
 # ----------------------------------------------------------------------------
 # Parse a given log line with a given dictionary of regular expressions
@@ -101,7 +228,479 @@ def parseLine(logger, logLine, regexMap, matchCounters):
             if(matchCounters.has_key(key)):
                 matchCounters[key] += 1
             else:
-                matchCounters[key] = 1  
+                matchCounters[key] = 1
+
+
+# ----------------------------------------------------------------------------
+# Hourly buckets of match counters. The scan window is rolled forward by
+# dropping the buckets that fell out of it.
+# ----------------------------------------------------------------------------
+
+def newBucket():
+    return {'lines': 0, 'critical': {}, 'warning': {}, 'all': HeavyHitters(topCapacity)}
+
+
+def mergeCounters(target, source):
+    for (key, count) in source.iteritems():
+        target[key] = target.get(key, 0) + count
+
+
+def mergeBucket(target, source):
+    target['lines'] += source['lines']
+    mergeCounters(target['critical'], source['critical'])
+    mergeCounters(target['warning'], source['warning'])
+    for (key, count) in source['all'].iteritems():
+        target['all'].add(key, count)
+
+
+# ----------------------------------------------------------------------------
+# Counters for a bounded number of keys ("Space-Saving" heavy hitters). Noisy
+# class names (e.g. '$$EnhancerByCGLIB$$...') would otherwise grow the 'all'
+# counters without limit. Once full, a new key replaces the key with the lowest
+# count and takes over that count, so the frequent keys are never undercounted.
+# The heap of (count, key) pairs is only updated lazily, when it is popped.
+# ----------------------------------------------------------------------------
+
+class HeavyHitters(dict):
+
+    def __init__(self, capacity, counts=None):
+        dict.__init__(self)
+        self.capacity = capacity
+        self.heap = []
+        if (counts):
+            for (key, count) in counts.iteritems():
+                self.add(key, count)
+
+    def add(self, key, count=1):
+        if key in self:
+            self[key] += count
+            return
+
+        if (len(self) >= self.capacity):
+            count += self.evict()
+        self[key] = count
+        heapq.heappush(self.heap, (count, key))
+
+    def evict(self):
+        while True:
+            (count, key) = heapq.heappop(self.heap)
+            if key not in self:
+                continue
+            if (self[key] == count):
+                del self[key]
+                return count
+            heapq.heappush(self.heap, (self[key], key))
+
+
+# ----------------------------------------------------------------------------
+# The top entries of a counter dictionary, largest first. Uses a heap if only
+# the first few are needed instead of sorting everything.
+# ----------------------------------------------------------------------------
+
+def topMatches(exceptionMatches, limit=None):
+    if (limit):
+        return heapq.nlargest(limit, exceptionMatches.iteritems(), key=operator.itemgetter(1))
+    return sorted(exceptionMatches.iteritems(), key=operator.itemgetter(1), reverse=True)
+
+
+# ----------------------------------------------------------------------------
+# Parse all complete lines of a log file (from its current position) into the
+# hourly buckets. Lines without a timestamp (stack traces) are counted in the
+# hour of the last timestamp seen. If a limit is given, no line starting after
+# that many bytes is parsed. Returns the hour of the last timestamp, the number
+# of lines scanned and the number of bytes consumed.
+# ----------------------------------------------------------------------------
+
+def scanLines(logger, logFile, buckets, traces, hour, limit=None):
+
+    scannedLines = 0
+    consumed = 0
+    bucket = buckets.setdefault(hour, newBucket())
+    trace = None
+
+    for logLine in logFile:
+
+        # JBoss is still writing this line; leave it for the next run
+        if not logLine.endswith('\n'):
+            break
+
+        # The rest belongs to the next shard
+        if limit is not None and consumed >= limit:
+            break
+
+        scannedLines += 1
+        consumed += len(logLine)
+
+        # Switch buckets whenever a line with a new hour shows up
+        if logLine[:13] != hour and logTimeRegex.match(logLine):
+            hour = logLine[:13]
+            bucket = buckets.setdefault(hour, newBucket())
+
+        bucket['lines'] += 1
+
+        # Collect the top frames of the stack trace that follows an exception
+        if (trace is not None):
+            if (logLine.startswith(tracePrefix) and len(trace) <= traceFrames):
+                trace.append(logLine.strip())
+            else:
+                recordTrace(traces, traceHour, trace)
+                trace = None
+
+        if isCandidate(logLine):
+            exception = parseCandidate(logger, logLine, bucket)
+            if (exception and not logLine.startswith(tracePrefix)):
+                trace = [exception]
+                traceHour = hour
+
+    if (trace is not None):
+        recordTrace(traces, traceHour, trace)
+
+    return (hour, scannedLines, consumed)
+
+
+# ----------------------------------------------------------------------------
+# Count the matches of a line that passed the literal prefilter
+# ----------------------------------------------------------------------------
+
+def parseCandidate(logger, logLine, bucket):
+
+    # Parse the line for all critical exceptions
+    parseLine(logger, logLine, criticalRegex, bucket['critical'])
+
+    # Parse the line for all warning exceptions
+    parseLine(logger, logLine, warningRegex, bucket['warning'])
+
+    # Parse the line for any exception
+    m = anyException.search(logLine)
+    if (m):
+        bucket['all'].add(m.group(1))
+        return m.group(1)
+
+    return None
+
+
+# ----------------------------------------------------------------------------
+# Stack trace clusters: an LRU of fingerprint -> exception, top frames and
+# hourly counts. A trace is the exception of a log line plus the frames that
+# directly follow it; exceptions without frames are not clustered.
+# ----------------------------------------------------------------------------
+
+def recordTrace(traces, hour, trace):
+
+    if (len(trace) < 2):
+        return
+
+    fingerprint = hashlib.sha1('\n'.join(trace)).hexdigest()[:12]
+    entry = traces.pop(fingerprint, None)
+    if (entry is None):
+        entry = {'exception': trace[0], 'frames': trace[1:], 'hourly': {}}
+    traces[fingerprint] = entry
+    entry['hourly'][hour] = entry['hourly'].get(hour, 0) + 1
+
+    if (len(traces) > traceCapacity):
+        traces.popitem(last=False)
+
+
+def mergeTraces(target, source, leadingHour):
+
+    for (fingerprint, entry) in source.iteritems():
+        targetEntry = target.pop(fingerprint, None)
+        if (targetEntry is None):
+            targetEntry = {'exception': entry['exception'], 'frames': entry['frames'], 'hourly': {}}
+        target[fingerprint] = targetEntry
+
+        # Traces from before the first timestamp of a range belong to the previous hour
+        for (traceHour, count) in entry['hourly'].iteritems():
+            if (traceHour is None):
+                traceHour = leadingHour
+            targetEntry['hourly'][traceHour] = targetEntry['hourly'].get(traceHour, 0) + count
+
+    while (len(target) > traceCapacity):
+        target.popitem(last=False)
+
+
+def expireTraces(traces, firstBucket):
+
+    for (fingerprint, entry) in traces.items():
+        for traceHour in entry['hourly'].keys():
+            if (traceHour < firstBucket):
+                del entry['hourly'][traceHour]
+        if (len(entry['hourly']) < 1):
+            del traces[fingerprint]
+
+
+# ----------------------------------------------------------------------------
+# Helpers for memory-mapped log files: find the first timestamped line that
+# starts at or after a given offset (returns 'end' if there is none), and count
+# the lines of a range without creating a string per line.
+# ----------------------------------------------------------------------------
+
+def findMappedTimestamp(buf, offset, end):
+
+    if (offset > 0 and buf[offset - 1] != '\n'):
+        offset = buf.find('\n', offset, end) + 1
+        if (offset == 0):
+            return end
+
+    while (offset < end):
+        if mappedTimeRegex.match(buf, offset):
+            return offset
+        offset = buf.find('\n', offset, end) + 1
+        if (offset == 0):
+            return end
+
+    return end
+
+
+def countMappedLines(buf, start, end):
+
+    lines = 0
+    while (start < end):
+        stop = min(start + minShardBytes, end)
+        lines += buf[start:stop].count('\n')
+        start = stop
+    return lines
+
+
+# ----------------------------------------------------------------------------
+# Scan a range of a memory-mapped log file. The range is cut into hours by
+# bisecting for the first line of the next hour, and the literal prefilter runs
+# directly over the mapped buffer. Only the lines it hits are ever copied out.
+# ----------------------------------------------------------------------------
+
+def scanMappedLines(logger, buf, start, end, buckets, traces):
+
+    hour = None
+    scannedLines = 0
+    segmentEnd = findMappedTimestamp(buf, start, end)
+
+    while (start < end):
+        bucket = buckets.setdefault(hour, newBucket())
+        lines = countMappedLines(buf, start, segmentEnd)
+        bucket['lines'] += lines
+        scannedLines += lines
+
+        offset = start
+        while True:
+            m = candidateRegex.search(buf, offset, segmentEnd)
+            if (not m):
+                break
+            lineStart = max(buf.rfind('\n', start, m.start()) + 1, start)
+            lineEnd = buf.find('\n', m.end(), segmentEnd) + 1
+            exception = parseCandidate(logger, buf[lineStart:lineEnd], bucket)
+            offset = lineEnd
+
+            # Collect the top frames of the stack trace that follows an exception
+            if (exception and buf[lineStart:lineStart + len(tracePrefix)] != tracePrefix):
+                trace = [exception]
+                frameStart = lineEnd
+                while (len(trace) <= traceFrames
+                       and buf[frameStart:frameStart + len(tracePrefix)] == tracePrefix):
+                    frameEnd = buf.find('\n', frameStart, segmentEnd) + 1
+                    if (frameEnd == 0):
+                        break
+                    trace.append(buf[frameStart:frameEnd].strip())
+                    frameStart = frameEnd
+                recordTrace(traces, hour, trace)
+
+        # The next segment covers the hour of the line we stopped at
+        start = segmentEnd
+        if (start >= end):
+            break
+        hour = buf[start:start + 13]
+
+        low = start
+        high = end
+        while (low < high):
+            middle = (low + high) // 2
+            lineStart = findMappedTimestamp(buf, middle, end)
+            if (lineStart >= end or buf[lineStart:lineStart + 13] > hour):
+                high = middle
+            else:
+                low = middle + 1
+        segmentEnd = findMappedTimestamp(buf, low, end)
+
+    return (hour, scannedLines)
+
+
+# ----------------------------------------------------------------------------
+# Split the rest of a log file, starting at the given offset, into byte ranges
+# that can be scanned in parallel. The last range ends at EOF (None), so that
+# lines appended to the current log in the meantime are picked up as well.
+# ----------------------------------------------------------------------------
+
+def splitLogFile(logFileName, offset, shards, useMmap):
+
+    # Compressed logs can only be streamed from the start
+    if isCompressed(logFileName):
+        return [(logFileName, offset, None, False)]
+
+    size = os.path.getsize(logFileName) - offset
+    shards = min(shards, size // minShardBytes)
+    if (shards <= 1):
+        return [(logFileName, offset, None, useMmap)]
+
+    step = size // shards
+    logRanges = []
+    for i in range(0, shards - 1):
+        logRanges.append((logFileName, offset + i * step, offset + (i + 1) * step, useMmap))
+    logRanges.append((logFileName, offset + (shards - 1) * step, None, useMmap))
+    return logRanges
+
+
+# ----------------------------------------------------------------------------
+# Scan one byte range of a log file; this runs in the worker processes for
+# parallel scans. A range starting in the middle of a line resumes at the next
+# line, and the line running across the end of a range belongs to that range.
+# Lines before the first timestamp are collected in the bucket for hour 'None',
+# the caller adds them to the last hour of the previous range.
+# ----------------------------------------------------------------------------
+
+def scanRange(logRange):
+
+    (logFileName, startOffset, endOffset, useMmap) = logRange
+    buckets = {}
+    traces = OrderedDict()
+
+    if isCompressed(logFileName):
+        return scanCompressedRange(logFileName, startOffset)
+
+    with open(logFileName, 'rb') as logFile:
+        if (useMmap):
+            return scanMappedRange(logFile, startOffset, endOffset)
+
+        if (startOffset > 0):
+            logFile.seek(startOffset - 1)
+            logFile.readline()
+        position = logFile.tell()
+
+        limit = None
+        if (endOffset is not None):
+            limit = max(endOffset - position, 0)
+
+        (hour, scannedLines, consumed) = scanLines(logger, logFile, buckets, traces, None, limit)
+
+        return {
+                'buckets'   : buckets,
+                'traces'    : traces,
+                'lastHour'  : hour,
+                'lines'     : scannedLines,
+                'bytes'     : consumed,
+                'inode'     : os.fstat(logFile.fileno()).st_ino,
+                'endOffset' : position + consumed
+                }
+
+
+def scanCompressedRange(logFileName, startOffset):
+
+    buckets = {}
+    traces = OrderedDict()
+    decompressor = openCompressedLog(logFileName)
+    try:
+        logFile = decompressor.stdout
+
+        # The start offset is within the decompressed data; read up to it
+        remaining = startOffset
+        while (remaining > 0):
+            skipped = logFile.read(min(remaining, minShardBytes))
+            if not skipped:
+                break
+            remaining -= len(skipped)
+
+        (hour, scannedLines, consumed) = scanLines(logger, logFile, buckets, traces, None)
+    finally:
+        decompressor.stdout.close()
+        decompressor.wait()
+
+    return {
+            'buckets'   : buckets,
+            'traces'    : traces,
+            'lastHour'  : hour,
+            'lines'     : scannedLines,
+            'bytes'     : consumed,
+            'inode'     : os.stat(logFileName).st_ino,
+            'endOffset' : startOffset + consumed
+            }
+
+
+def scanMappedRange(logFile, startOffset, endOffset):
+
+    buckets = {}
+    traces = OrderedDict()
+    result = {
+              'buckets'   : buckets,
+              'traces'    : traces,
+              'lastHour'  : None,
+              'lines'     : 0,
+              'bytes'     : 0,
+              'inode'     : os.fstat(logFile.fileno()).st_ino,
+              'endOffset' : startOffset
+              }
+
+    # Empty files cannot be mapped
+    if (os.fstat(logFile.fileno()).st_size == 0):
+        buckets[None] = newBucket()
+        return result
+
+    buf = mmap.mmap(logFile.fileno(), 0, prot=mmap.PROT_READ)
+    try:
+        # Same line ownership as for the line-by-line scan. An incomplete
+        # trailing line is left for the next run.
+        start = startOffset
+        if (start > 0 and buf[start - 1] != '\n'):
+            start = buf.find('\n', start) + 1 or len(buf)
+
+        end = buf.rfind('\n') + 1
+        if (endOffset is not None and endOffset < end):
+            end = buf.find('\n', max(endOffset - 1, start)) + 1
+        end = max(start, end)
+
+        buckets[None] = newBucket()
+        (hour, scannedLines) = scanMappedLines(logger, buf, start, end, buckets, traces)
+        result['lastHour'] = hour
+        result['lines'] = scannedLines
+        result['bytes'] = end - start
+        result['endOffset'] = end
+    finally:
+        buf.close()
+
+    return result
+
+
+# ----------------------------------------------------------------------------
+# Load and save the checkpoint of the previous run
+# ----------------------------------------------------------------------------
+
+def loadState(logger, stateFileName, logRoot):
+
+    if not os.path.exists(stateFileName):
+        logger.debug("No checkpoint found in " + stateFileName)
+        return None
+
+    try:
+        with open(stateFileName, 'r') as f:
+            state = json.load(f)
+    except Exception as e:
+        logger.debug("Ignoring unreadable checkpoint " + stateFileName + ": " + str(e))
+        return None
+
+    if state.get('version') != stateVersion or state.get('logRoot') != logRoot:
+        logger.debug("Ignoring checkpoint of a different version or log root")
+        return None
+
+    return state
+
+
+def saveState(logger, stateFileName, state):
+
+    # Write to a temp file first, so an aborted run never leaves a broken checkpoint
+    try:
+        tempFileName = stateFileName + '.tmp'
+        with open(tempFileName, 'w') as f:
+            json.dump(state, f)
+        os.rename(tempFileName, stateFileName)
+    except Exception as e:
+        logger.warning("Unable to save checkpoint " + stateFileName + ": " + str(e))
 
 
 # ----------------------------------------------------------------------------
@@ -116,7 +715,7 @@ def printSortedReport(exceptionMatches, logTimeSpan, title, limit=None):
     print title
     print "-----------------------------------------------------------------------------\n"
 
-    sortedExceptions = sorted(exceptionMatches.iteritems(), key=operator.itemgetter(1), reverse=True)
+    sortedExceptions = topMatches(exceptionMatches, limit)
     rowCount = 0;
     
     # Stupid old Python 2.6 does not have timedelta.total_seconds() yet...
@@ -135,6 +734,90 @@ def printSortedReport(exceptionMatches, logTimeSpan, title, limit=None):
             
 
 
+# ----------------------------------------------------------------------------
+# Hourly histogram of the given counter key, in the order of 'hours'
+# ----------------------------------------------------------------------------
+
+def hourlyHistogram(buckets, hours, category, key):
+    return [buckets[bucketHour][category].get(key, 0) for bucketHour in hours]
+
+
+# ----------------------------------------------------------------------------
+# Build the list of report rows for the given result dictionary
+# ----------------------------------------------------------------------------
+
+def reportRows(exceptionMatches, buckets, hours, category, logTimeSpanHours, limit=None):
+
+    sortedExceptions = topMatches(exceptionMatches, limit)
+
+    rows = []
+    for (exception, count) in sortedExceptions:
+        rows.append({
+                     'exception' : exception,
+                     'count'     : count,
+                     'eph'       : float(count) / float(logTimeSpanHours),
+                     'hourly'    : hourlyHistogram(buckets, hours, category, exception)
+                     })
+    return rows
+
+
+# ----------------------------------------------------------------------------
+# Build the list of report rows for the stack trace clusters, most frequent first
+# ----------------------------------------------------------------------------
+
+def traceRows(traces, hours, logTimeSpanHours, limit):
+
+    rows = []
+    for (fingerprint, entry) in traces.iteritems():
+        hourly = [entry['hourly'].get(bucketHour, 0) for bucketHour in hours]
+        rows.append({
+                     'fingerprint' : fingerprint,
+                     'exception'   : entry['exception'],
+                     'frames'      : entry['frames'],
+                     'count'       : sum(hourly),
+                     'eph'         : float(sum(hourly)) / float(logTimeSpanHours),
+                     'hourly'      : hourly
+                     })
+
+    rows.sort(key=operator.itemgetter('count'), reverse=True)
+    return rows[:limit]
+
+
+# ----------------------------------------------------------------------------
+# Print the stack trace clusters, each with its top frames
+# ----------------------------------------------------------------------------
+
+def printTraceReport(rows, title):
+
+    if (len(rows)<1):
+        return
+
+    print "-----------------------------------------------------------------------------"
+    print title
+    print "-----------------------------------------------------------------------------\n"
+
+    print '   {0:>6}  {1:>7}  {2}'.format( "Count", "EPH", "Exception [Fingerprint]")
+    print "   --------------------------------------------------------------------------"
+    for row in rows:
+        print '   {0:>6}  {1:>7.1f}  {2} [{3}]'.format(row['count'], row['eph'], row['exception'], row['fingerprint'])
+        for frame in row['frames']:
+            print '                       ' + frame
+
+    print "\n\n"
+
+
+# ----------------------------------------------------------------------------
+# Format a Nagios performance data value. Labels must not contain '=' or "'".
+# ----------------------------------------------------------------------------
+
+def perfData(label, value, uom='', warn=None, crit=None):
+    label = label.replace('=', '-').replace("'", '"')
+    thresholds = ''
+    if (warn is not None or crit is not None):
+        thresholds = ';{0};{1}'.format('' if warn is None else warn, '' if crit is None else crit)
+    return "'{0}'={1}{2}{3}".format(label, value, uom, thresholds)
+
+
 # ----------------------------------------------------------------------------
 # Script starts here
 # ----------------------------------------------------------------------------
@@ -155,6 +838,22 @@ parser.add_option("-e", "--min-eph", dest="min_eph", type="float",
                   help="Minimum value for EPH before an exception is shown in 'Top 20'")
 parser.add_option("-p", "--min-pls", dest="min_pls",
                   help="Minimum version of PLS to be present on localhost for scan, ex: 'R5_7_14'")
+parser.add_option("-s", "--state-file", dest="state_file",
+                  help="Checkpoint file for incremental scans, default: " + stateFile)
+parser.add_option("-f", "--full-scan", action="store_true", dest="full_scan",
+                  help="Ignore the checkpoint and re-scan the whole scan window")
+parser.add_option("-j", "--jobs", dest="jobs", type="int", default=1,
+                  help="Number of processes to scan the log files with in parallel")
+parser.add_option("-m", "--mmap", action="store_true", dest="mmap",
+                  help="Memory-map the log files and only extract the lines with matches")
+parser.add_option("--trace-frames", dest="trace_frames", type="int", default=traceFrames,
+                  help="Number of top stack frames that identify a stack trace cluster, default: " + str(traceFrames))
+parser.add_option("--trace-capacity", dest="trace_capacity", type="int", default=traceCapacity,
+                  help="Maximum number of stack trace clusters to keep track of, default: " + str(traceCapacity))
+parser.add_option("--top-capacity", dest="top_capacity", type="int", default=topCapacity,
+                  help="Maximum number of distinct exceptions to count per hour, default: " + str(topCapacity))
+parser.add_option("-o", "--format", dest="format", type="choice", choices=['text', 'json'], default='text',
+                  help="Report format: 'text' (default, with Nagios perfdata) or 'json'")
 
 (options, args) = parser.parse_args()
 
@@ -164,6 +863,13 @@ if(options.debug):
 
 if(options.logroot):
     logRoot = options.logroot
+
+if(options.state_file):
+    stateFile = options.state_file
+
+traceFrames = options.trace_frames
+traceCapacity = options.trace_capacity
+topCapacity = options.top_capacity
     
 # Configure logging
 logging.basicConfig(level=logLevel, format='%(relativeCreated)d\t%(levelname)s\t%(message)s')
@@ -173,25 +879,11 @@ logger = logging.getLogger()
 if (options.min_pls):
 
     try:
-        from httplib import HTTPConnection
-        import urllib
-        current_pls = None
-        
+        from plsversion import PlsVersion
+
         logger.debug("Checking PLS version on local server...")
-        http = HTTPConnection('localhost', 8080, timeout=5)
-        params = urllib.urlencode({'authUserName' : 'gwnreporter', 'authUserPassword' : 'ixNq^4nJJeX1', 'runCheck': 'com.gwn.plife.sysinfo.checks.AppVersionCheck'})
-        headers = {"Content-type": "application/x-www-form-urlencoded", "Accept": "text/plain"}
-        http.request("POST", "/Admin/sysinfo/Sysinfo.action", params, headers)
-        response = http.getresponse()
-
-        if (response.status == 200):
-            data = response.read()
-            m = re.search('<app-version>(.*)</app-version>', data, re.MULTILINE)
-            if (m):
-                current_pls = m.group(1)
-            
-        http.close()
-        
+        current_pls = PlsVersion.get_version(timeout=5)
+
         if (not current_pls or current_pls < options.min_pls):
             print "UNKNOWN: Unsupported version of PLS found: '" + str(current_pls) \
                 + "' (need at least " + options.min_pls + ")"
@@ -206,15 +898,10 @@ if (options.min_pls):
 
 # Set up a few variables
 scanWindow = timedelta(hours=scanWindowHours)
-scanWindowStart = datetime.now() - scanWindow
+scanNow = datetime.now()
+scanWindowStart = scanNow - scanWindow
 logger.debug("Scan window starts at " + str(scanWindowStart))
 logSuffix = []
-logTimePattern = '^([0-9]{4}-[0-9]{2}-[0-9]{2} [0-9]{2}:[0-9]{2}:[0-9]{2}),'
-
-# Count the matches
-criticalMatches = {}
-warningMatches = {}
-allExceptionMatches = {}
 
 
 # Generate an array of log suffixes
@@ -223,89 +910,185 @@ for i in range(20,0,-1):
     
 logSuffix.append('')
 
-# Find the oldest logfile that has data within the scan window
-logCount = 0
+# Collect the existing log files, oldest first. Prefer the plain file, in
+# case a rotated log is being compressed right now.
+logFileNames = []
+for suffix in logSuffix:
+    for extension in [''] + sorted(decompressors.keys()):
+        logFileName = logRoot + '/' + logName + suffix + extension
+        if os.path.exists(logFileName):
+            logFileNames.append(logFileName)
+            break
 
-for s in range(0,len(logSuffix)):
-    logFileName = logRoot + '/' + logName + logSuffix[s]
-    
-    if os.path.exists(logFileName):
-        logCount +=1
-        fileTime = datetime.fromtimestamp(os.path.getmtime(logFileName))
-        logger.debug("File exists: '" + logSuffix[s] + "', time: " + str(fileTime) + ", in scan range: "
+if (len(logFileNames)<1):
+    print "CRITICAL: Cannot find a single log file to parse"
+    exit(2)
+
+# Try to continue where the previous run stopped. JBoss rotates by renaming,
+# so the checkpointed file is found by its inode, even if it is 'server.log.N' by now.
+state = None
+if (not options.full_scan):
+    state = loadState(logger, stateFile, logRoot)
+
+if (state):
+    startIndex = None
+    for s in range(0,len(logFileNames)):
+        fileStat = os.stat(logFileNames[s])
+        if (fileStat.st_ino == state['inode']):
+            startIndex = s
+            # Truncated (e.g. by reclaim-space) since the last run? Start over in this file.
+            startOffset = state['offset'] if fileStat.st_size >= state['offset'] else 0
+
+    if (startIndex is None):
+        logger.debug("Checkpointed log file is gone. Falling back to a full scan.")
+        state = None
+    else:
+        logger.debug("Resuming scan of " + logFileNames[startIndex] + " at offset " + str(startOffset))
+        buckets = state['buckets']
+        for bucket in buckets.itervalues():
+            bucket['all'] = HeavyHitters(topCapacity, bucket['all'])
+        traces = OrderedDict(state['traces'])
+        hour = state['lastHour']
+        firstLogLineDate = datetime.strptime(state['firstLogLineDate'], logTimeFormat)
+
+if (not state):
+    # Find the oldest logfile that has data within the scan window
+    startIndex = len(logFileNames) - 1
+    startOffset = 0
+    for s in range(0,len(logFileNames)):
+        fileTime = datetime.fromtimestamp(os.path.getmtime(logFileNames[s]))
+        logger.debug("File exists: '" + logFileNames[s] + "', time: " + str(fileTime) + ", in scan range: "
                      + str(fileTime>scanWindowStart))
-        
+
         if (fileTime>scanWindowStart):
-            logger.debug("Found oldest file that needs to be scanned: " + logSuffix[s])
+            logger.debug("Found oldest file that needs to be scanned: " + logFileNames[s])
+            startIndex = s
             break
 
-if (logCount<1):
-    print "CRITICAL: Cannot find a single log file to parse"
-    exit(2)
-    
+    buckets = {}
+    traces = OrderedDict()
+    hour = None
+    firstLogLineDate = None
 
-firstLogLineDate = None
-totalLines = 0
+scannedLines = 0
+scannedBytes = 0
 returnValue = 0
 scanStart = time.time()
 
-# Now iterate over the files within the scan window and work on them
-for s in range(s,len(logSuffix)):
-    logFileName = logRoot + '/' + logName + logSuffix[s]
-    logger.debug("Scanning log file " + logFileName + "...")
-    
-    try:
-        logFile = open(logFileName, 'r')
-        
-        # Calculate how large our log time span is
+# Plan the byte ranges to scan, starting with the first file within the scan window
+logRanges = []
+try:
+    for s in range(startIndex,len(logFileNames)):
+        logFileName = logFileNames[s]
+        offset = startOffset if s == startIndex else 0
+
+        # On a full scan, skip everything before the scan window first
         if (not firstLogLineDate):
-            logLineDate = findFirstLine(logger, logFile, scanWindowStart, logTimePattern)
-            
+            logger.debug("Looking for the scan window start in " + logFileName + "...")
+            if isCompressed(logFileName):
+                decompressor = openCompressedLog(logFileName)
+                (logLineDate, offset) = findFirstStreamedLine(logger, decompressor.stdout, scanWindowStart)
+                decompressor.stdout.close()
+                decompressor.wait()
+            else:
+                with open(logFileName, 'rb') as logFile:
+                    logLineDate = findFirstLine(logger, logFile, scanWindowStart)
+                    offset = logFile.tell()
+
             # If no logLineDate was found in the log, skip this log and scan the next
             if (not logLineDate):
-                logFile.close()
                 continue
-            
+
             firstLogLineDate = logLineDate
-            logTimeSpan = datetime.now()-logLineDate
-            logger.debug("Available log data spans: " + str(logTimeSpan))
-        
-            # Add a grace period of a few minutes, in case the log was quiet for a while
-            if (firstLogLineDate-timedelta(minutes=10) > scanWindowStart):
-                print "WARNING: The available log entries do not fill the scan window. Log data available for: " \
-                            + str(logTimeSpan)
-                returnValue = 1           
-                
-
-        for logLine in logFile:
-            
-            totalLines += 1
-            
-            # Parse the line for all critical exceptions
-            parseLine(logger, logLine, criticalRegex, criticalMatches)
-        
-            # Parse the line for all warning exceptions
-            parseLine(logger, logLine, warningRegex, warningMatches)
-            
-            # Parse the line for any exception
-            m = anyException.search(logLine)
-            if (m):
-                if (allExceptionMatches.has_key(m.group(1))):
-                    allExceptionMatches[m.group(1)] += 1
-                else:
-                    allExceptionMatches[m.group(1)] = 1
-        
-        logFile.close()
-    except Exception as e:
-        print "CRITICAL: Error parsing log file: " + str(e) + "\n"
-        traceback.print_exc(file=sys.stdout)
-        exit(2)
+            hour = logLineDate.strftime(bucketTimeFormat)
+
+        logRanges.extend(splitLogFile(logFileName, offset, options.jobs, options.mmap))
+
+    # Now work on them, in parallel if requested
+    logger.debug("Scanning " + str(len(logRanges)) + " ranges of log files with "
+                 + str(options.jobs) + " processes...")
+    if (options.jobs > 1 and len(logRanges) > 1):
+        pool = multiprocessing.Pool(options.jobs)
+        results = pool.map(scanRange, logRanges, 1)
+        pool.close()
+        pool.join()
+    else:
+        results = map(scanRange, logRanges)
+except Exception as e:
+    print "CRITICAL: Error parsing log file: " + str(e) + "\n"
+    traceback.print_exc(file=sys.stdout)
+    exit(2)
+
+# Merge the partial results in log order
+for result in results:
+    leadingBucket = result['buckets'].pop(None)
+    if (leadingBucket['lines'] > 0):
+        mergeBucket(buckets.setdefault(hour, newBucket()), leadingBucket)
+    mergeTraces(traces, result['traces'], hour)
+
+    for (bucketHour, bucket) in result['buckets'].iteritems():
+        mergeBucket(buckets.setdefault(bucketHour, newBucket()), bucket)
+
+    if (result['lastHour']):
+        hour = result['lastHour']
+    scannedLines += result['lines']
+    scannedBytes += result['bytes']
+    lastInode = result['inode']
+    lastOffset = result['endOffset']
+
+# Roll the scan window forward: drop all hours that are completely outside of it
+firstBucket = scanWindowStart.strftime(bucketTimeFormat)
+for bucketHour in buckets.keys():
+    if (bucketHour < firstBucket):
+        del buckets[bucketHour]
+expireTraces(traces, firstBucket)
+
+# Remember where we stopped, so the next run only needs to parse new lines
+if (firstLogLineDate):
+    saveState(logger, stateFile, {
+                  'version'          : stateVersion,
+                  'logRoot'          : logRoot,
+                  'inode'            : lastInode,
+                  'offset'           : lastOffset,
+                  'lastHour'         : hour,
+                  'firstLogLineDate' : firstLogLineDate.strftime(logTimeFormat),
+                  'buckets'          : buckets,
+                  'traces'           : traces.items()
+                  })
 
-logger.debug("Total number of lines scanned: {0}".format(totalLines))
+# Count the matches within the scan window
+criticalMatches = {}
+warningMatches = {}
+allExceptionMatches = HeavyHitters(topCapacity)
+totalLines = 0
+
+for bucket in buckets.itervalues():
+    totalLines += bucket['lines']
+    mergeCounters(criticalMatches, bucket['critical'])
+    mergeCounters(warningMatches, bucket['warning'])
+    for (key, count) in bucket['all'].iteritems():
+        allExceptionMatches.add(key, count)
+
+logger.debug("Lines scanned in this run: {0}".format(scannedLines))
+logger.debug("Total number of lines in scan window: {0}".format(totalLines))
 if totalLines < 100:
     print "CRITICAL: Less than 100 lines of eligible log entries found. Something is not right.\n"
     exit(2)
 
+# Calculate how large our log time span is. Older data than the first line
+# we ever saw does not exist, so that limits the span in any case.
+if (len(buckets)>0):
+    firstLogLineDate = max(firstLogLineDate, datetime.strptime(min(buckets.keys()), bucketTimeFormat))
+logTimeSpan = scanNow-firstLogLineDate
+logger.debug("Available log data spans: " + str(logTimeSpan))
+
+# Add a grace period of a few minutes, in case the log was quiet for a while
+windowWarning = None
+if (firstLogLineDate-timedelta(minutes=10) > scanWindowStart):
+    windowWarning = "WARNING: The available log entries do not fill the scan window. Log data available for: " \
+                + str(logTimeSpan)
+    returnValue = 1
+
 # Separate the logging output a bit
 logger.debug("Generating report...\n\n")
 scanDuration = time.time() - scanStart
@@ -320,7 +1103,7 @@ returnValue = 0
 # Find the highest EPH in the allExceptionMatches
 highestEph = None
 if (len(allExceptionMatches)>0):
-    sortedAllExceptionMatches = sorted(allExceptionMatches.iteritems(), key=operator.itemgetter(1), reverse=True)
+    sortedAllExceptionMatches = topMatches(allExceptionMatches, 1)
     highestEph = {
                   'count'       : sortedAllExceptionMatches[0][1],
                   'exception'   : sortedAllExceptionMatches[0][0],
@@ -330,42 +1113,34 @@ if (len(allExceptionMatches)>0):
 
 # If there are _any_ critical exceptions, the final result will be 'CRITICAL'
 if (len(criticalMatches)>0):
-    print "CRITICAL: Critical exceptions found in the log!\n\n"
+    status = "CRITICAL: Critical exceptions found in the log!"
     returnValue = 2
 
 # If "-c" option was given, evaluate the highest EPH value for CRITICAL
 elif (options.critical and highestEph and highestEph['eph']>=options.critical):
-    print "CRITICAL: Highest number of 'exceptions per hour' exceeded critical threshold (" \
+    status = "CRITICAL: Highest number of 'exceptions per hour' exceeded critical threshold (" \
             + str(highestEph['eph']) + " " + highestEph['exception'] + " per hour)"
     returnValue = 2
     
 # If "-w" option was given, evaluate the highest EPH value for WARNING
 elif (options.warning and highestEph and highestEph['eph']>=options.warning):
-    print "WARNING: Highest number of 'exceptions per hour' exceeded warning threshold (" \
+    status = "WARNING: Highest number of 'exceptions per hour' exceeded warning threshold (" \
             + str(highestEph['eph']) + " " + highestEph['exception'] + " per hour)"
     returnValue = 1
     
 # If there are _any_ warning exceptions, the final result will be 'WARNING'   
 elif (len(warningMatches)>0):
-    print "WARNING: Dangerous exceptions found in the log! Please escalate to DEV.\n\n"
+    status = "WARNING: Dangerous exceptions found in the log! Please escalate to DEV."
     returnValue = 1
 
 else:
-    print "OK: No exceptions or problems found in the logs"
+    status = "OK: No exceptions or problems found in the logs"
     returnValue = 0
     
-
-# Need a separator line between Nagios summary and rest of the report
-print ""    
-printSortedReport(criticalMatches, logTimeSpan, 'Critical Exceptions found:')
-printSortedReport(warningMatches, logTimeSpan, 'Warning Exceptions found:')
-
 # If display restrictions were given on the command line, purge the allExceptionMatches first
+logTimeSpanHours = logTimeSpan.days * 24 + logTimeSpan.seconds / 3600.0
 if (options.min_count or options.min_eph):
     
-    # Okay, a bit repetitive to calculate this again here, but the script was a quick project ;-)
-    logTimeSpanHours = logTimeSpan.days * 24 + logTimeSpan.seconds / 3600.0
-    
     for key in allExceptionMatches.keys():
         
         if (options.min_count and allExceptionMatches[key] < options.min_count):
@@ -377,15 +1152,83 @@ if (options.min_count or options.min_eph):
             if (eph < options.min_eph):
                 del allExceptionMatches[key]
                 continue
-        
+
+# Hourly histograms cover the buckets within the scan window, oldest first
+hours = sorted(buckets.keys())
+criticalRows = reportRows(criticalMatches, buckets, hours, 'critical', logTimeSpanHours)
+warningRows = reportRows(warningMatches, buckets, hours, 'warning', logTimeSpanHours)
+allRows = reportRows(allExceptionMatches, buckets, hours, 'all', logTimeSpanHours, limit=20)
+clusterRows = traceRows(traces, hours, logTimeSpanHours, limit=10)
+
+if (options.format == 'json'):
+    print json.dumps({
+                      'status'           : status,
+                      'windowWarning'    : windowWarning,
+                      'highestEph'       : highestEph,
+                      'scanWindowStart'  : scanWindowStart.strftime(logTimeFormat),
+                      'scanWindowHours'  : scanWindowHours,
+                      'logTimeSpanHours' : logTimeSpanHours,
+                      'totalLines'       : totalLines,
+                      'scannedLines'     : scannedLines,
+                      'scannedBytes'     : scannedBytes,
+                      'scanDuration'     : scanDuration,
+                      'hours'            : hours,
+                      'hourlyLines'      : [buckets[bucketHour]['lines'] for bucketHour in hours],
+                      'critical'         : criticalRows,
+                      'warning'          : warningRows,
+                      'all'              : allRows,
+                      'traces'           : clusterRows
+                      }, indent=2, sort_keys=True)
+
+    # PLATSUP-16841: Always return "OK"
+    exit(0)
+
+# Nagios perfdata: totals on the status line, hourly histograms (as hours ago) at the end
+perfTotals = [
+              perfData('highest_eph', '{0:.1f}'.format(highestEph['eph'] if highestEph else 0.0),
+                       warn=options.warning, crit=options.critical),
+              perfData('critical', sum(criticalMatches.values())),
+              perfData('warning', sum(warningMatches.values())),
+              perfData('lines', totalLines),
+              perfData('new_lines', scannedLines),
+              perfData('bytes', scannedBytes, 'B'),
+              perfData('scan_time', '{0:.3f}'.format(scanDuration), 's')
+              ]
+
+currentHour = datetime.strptime(scanNow.strftime(bucketTimeFormat), bucketTimeFormat)
+hoursAgo = []
+for bucketHour in hours:
+    age = currentHour - datetime.strptime(bucketHour, bucketTimeFormat)
+    hoursAgo.append(age.days * 24 + age.seconds // 3600)
+perfHistograms = []
+for (bucketHour, ago) in zip(hours, hoursAgo):
+    perfHistograms.append(perfData('lines h-' + str(ago), buckets[bucketHour]['lines']))
+    perfHistograms.append(perfData('exceptions h-' + str(ago), sum(buckets[bucketHour]['all'].values())))
+for row in criticalRows + warningRows:
+    for (ago, count) in zip(hoursAgo, row['hourly']):
+        perfHistograms.append(perfData(row['exception'] + ' h-' + str(ago), count))
+
+# Nagios takes the first line as the plugin output, so the warning goes below it
+print status + " | " + " ".join(perfTotals) + "\n\n"
+if windowWarning:
+    print windowWarning
+
+# Need a separator line between Nagios summary and rest of the report
+print ""    
+printSortedReport(criticalMatches, logTimeSpan, 'Critical Exceptions found:')
+printSortedReport(warningMatches, logTimeSpan, 'Warning Exceptions found:')
 printSortedReport(allExceptionMatches, logTimeSpan, 'Top 20 of all Exceptions found:', limit=20)
+printTraceReport(clusterRows, 'Top 10 Stack Trace Clusters found:')
 
 print "{0:<20} : {1:>20}".format("Scan window start", scanWindowStart.strftime("%Y-%m-%d %H:%M"))
 print "{0:<20} : {1:>20}".format("Scan window span", str(scanWindow))
 print "{0:<20} : {1:>20}".format("Scanned log data", str(logTimeSpan))
 print "{0:<20} : {1:>20}".format("Total lines scanned", totalLines)
+print "{0:<20} : {1:>20}".format("New lines scanned", scannedLines)
+print "{0:<20} : {1:>20}".format("New bytes scanned", scannedBytes)
 print "{0:<20} : {1:>20.2f} seconds".format("Scan time", scanDuration)
-print "{0:<20} : {1:>20.2f} lines per second".format("Scan rate", totalLines / scanDuration)
+print "{0:<20} : {1:>20.2f} lines per second".format("Scan rate", scannedLines / max(scanDuration, 0.001)) \
+        + " | " + "\n".join(perfHistograms)
 
 # PLATSUP-16841: Always return "OK"
 returnValue = 0
@@ -0,0 +1,110 @@
+#!/usr/bin/python2
+
+from httplib import HTTPConnection
+from json import dump, load
+from os import getpid, getuid, rename, unlink
+from os.path import isdir, getmtime
+from re import search
+from time import time
+from urllib import urlencode
+
+
+class PlsVersion:
+    """
+    Helper class for looking up the version of the PLS deployed on the local
+    JBoss/Wildfly. The Sysinfo servlet is expensive on a loaded appserver, so
+    the result is cached on disk for all scripts that need it. The cache is
+    valid until its TTL expires or the deployment directory changes (which
+    happens on every deployment).
+    """
+
+    # One cache per user: /var/tmp is sticky, so a file created by root (the
+    # server-report cron) could not be replaced by nagios, and vice versa
+    cache_file = '/var/tmp/pls-version.{0}.cache'.format(getuid())
+    cache_ttl = 3600
+
+    deployment_dirs = ['/opt/wildfly/standalone/deployments',
+                       '/opt/jboss7/standalone/deployments']
+
+    @staticmethod
+    def find_deployment_dir():
+
+        for d in PlsVersion.deployment_dirs:
+            if isdir(d):
+                return d
+        return None
+
+    @staticmethod
+    def query(timeout):
+        """
+        Ask the local JBoss/Wildfly for the PLS version. Returns None if the
+        server answered without a version. Connection problems and timeouts
+        are raised to the caller.
+        """
+        params = urlencode({'authUserName': 'gwnreporter', 'authUserPassword': 'ixNq^4nJJeX1',
+                            'runCheck': 'com.gwn.plife.sysinfo.checks.AppVersionCheck'})
+        pls = HTTPConnection('localhost', 8080, timeout=timeout)
+        try:
+            pls.request('GET', '/Admin/sysinfo/Sysinfo.action?' + params)
+            res = pls.getresponse()
+            if res.status == 200:
+                m = search('<app-version>(.*)</app-version>', res.read())
+                if m is not None:
+                    return m.group(1)
+            return None
+        finally:
+            pls.close()
+
+    @staticmethod
+    def read_cache(deployment_dir, deployment_mtime):
+
+        try:
+            with open(PlsVersion.cache_file, 'r') as c:
+                cache = load(c)
+            if cache['deployment_dir'] == deployment_dir \
+                    and cache['deployment_mtime'] == deployment_mtime \
+                    and 0 <= time() - cache['timestamp'] < PlsVersion.cache_ttl:
+                return cache['version']
+        except Exception:
+            pass
+        return None
+
+    @staticmethod
+    def write_cache(deployment_dir, deployment_mtime, version):
+
+        # Failing to replace the cache is not an error. The next lookup simply
+        # asks JBoss again.
+        temp_file = '{0}.{1}'.format(PlsVersion.cache_file, getpid())
+        try:
+            with open(temp_file, 'w') as c:
+                dump({'deployment_dir': deployment_dir, 'deployment_mtime': deployment_mtime,
+                      'timestamp': time(), 'version': version}, c)
+            rename(temp_file, PlsVersion.cache_file)
+        except Exception:
+            try:
+                unlink(temp_file)
+            except OSError:
+                pass
+
+    @staticmethod
+    def get_version(timeout=10):
+        """
+        Return the deployed PLS version, from the cache if possible. Returns
+        None if the server did not report a version; that is never cached.
+        """
+        deployment_dir = PlsVersion.find_deployment_dir()
+        deployment_mtime = getmtime(deployment_dir) if deployment_dir else None
+
+        version = PlsVersion.read_cache(deployment_dir, deployment_mtime)
+        if version is not None:
+            return version
+
+        version = PlsVersion.query(timeout)
+        if version is not None:
+            PlsVersion.write_cache(deployment_dir, deployment_mtime, version)
+        return version
+
+
+if __name__ == '__main__':
+
+    print PlsVersion.get_version()
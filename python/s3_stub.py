@@ -0,0 +1,319 @@
+#!/usr/bin/python2
+'''
+Minimal S3-compatible stand-in for benchmarking and testing backup_to_s3.py
+without talking to Amazon. Speaks just enough of the S3 REST API (path-style
+requests, no authentication) for boto: bucket listing, HEAD/GET/PUT/DELETE
+of keys, server-side copies (also of parts) and multipart uploads.
+
+Uploaded data is only checksummed and counted, not kept, unless --keep-data
+is given. A benchmark can then push many GB through it with flat memory use.
+Per-request latency and a per-connection bandwidth cap make it behave like a
+single, latency-bound S3 stream.
+'''
+
+from optparse import OptionParser
+from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+from SocketServer import ThreadingMixIn
+from threading import Thread, Lock
+from hashlib import md5
+from time import time, sleep
+from urllib import unquote
+from urlparse import urlparse, parse_qs
+from uuid import uuid4
+from xml.sax.saxutils import escape
+import re
+
+
+class StoredObject(object):
+    '''
+    A key in the stub. The data itself is only there with keep_data.
+    '''
+
+    def __init__(self, size, etag, meta, data=None):
+        self.size = size
+        self.etag = etag
+        self.meta = meta
+        self.data = data
+
+
+
+class S3StubHandler(BaseHTTPRequestHandler):
+    '''
+    Handles the S3 requests. The state lives in the server.
+    '''
+
+    protocol_version = 'HTTP/1.1'
+
+    def log_message(self, format, *args):
+        if self.server.verbose:
+            BaseHTTPRequestHandler.log_message(self, format, *args)
+
+    def parse_request_path(self):
+        url = urlparse(self.path)
+        parts = unquote(url.path)[1:].split('/', 1)
+        if self.server.latency:
+            sleep(self.server.latency)
+        self.server.count_request(self.command)
+        return (parts[0], parts[1] if len(parts) > 1 else '', parse_qs(url.query, keep_blank_values=True))
+
+    def read_body(self):
+        '''
+        Read the request body in blocks, honoring the bandwidth cap. Returns
+        the size, the MD5 and the data (if it is kept).
+        '''
+        remaining = int(self.headers.get('Content-Length', 0))
+        size = remaining
+        checksum = md5()
+        data = [] if self.server.keep_data else None
+        start = time()
+        while remaining > 0:
+            buff = self.rfile.read(min(remaining, 256 * 1024))
+            if not buff:
+                break
+            remaining -= len(buff)
+            checksum.update(buff)
+            if data is not None:
+                data.append(buff)
+            if self.server.rate:
+                ahead = (size - remaining) / float(self.server.rate) - (time() - start)
+                if ahead > 0:
+                    sleep(ahead)
+        self.server.count_bytes(size - remaining)
+        return (size, checksum.hexdigest(), ''.join(data) if data is not None else None)
+
+    def get_meta(self):
+        return dict((k.lower(), v) for (k, v) in self.headers.items() if k.lower().startswith('x-amz-meta-'))
+
+    def reply(self, code, body='', headers={}):
+        self.send_response(code)
+        for (name, value) in headers.items():
+            self.send_header(name, value)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        if self.command != 'HEAD':
+            self.wfile.write(body)
+
+    def reply_error(self, code, error):
+        self.reply(code, '<?xml version="1.0" encoding="UTF-8"?>\n<Error><Code>{0}</Code>'
+                   '<Message>{0}</Message></Error>'.format(error))
+
+    def do_HEAD(self):
+        self.do_GET()
+
+    def do_GET(self):
+        (bucket, key, query) = self.parse_request_path()
+        if not key:
+            return self.list_bucket(bucket, query)
+        if 'uploadId' in query:
+            return self.list_parts(query['uploadId'][0])
+
+        obj = self.server.objects.get((bucket, key))
+        if obj is None:
+            return self.reply_error(404, 'NoSuchKey')
+        headers = dict(obj.meta)
+        headers['ETag'] = '"{0}"'.format(obj.etag)
+        headers['Last-Modified'] = 'Thu, 01 Jan 2015 00:00:00 GMT'
+        if obj.data is None:
+            # Only the size is known, so HEAD is all there is
+            if self.command != 'HEAD':
+                return self.reply_error(501, 'NotImplemented')
+            headers['Content-Length'] = str(obj.size)
+            self.send_response(200)
+            for (name, value) in headers.items():
+                self.send_header(name, value)
+            self.end_headers()
+            return
+        self.reply(200, obj.data, headers)
+
+    def list_bucket(self, bucket, query):
+        prefix = query.get('prefix', [''])[0]
+        marker = query.get('marker', [''])[0]
+        max_keys = int(query.get('max-keys', ['1000'])[0])
+        with self.server.lock:
+            keys = sorted(k for (b, k) in self.server.objects if b == bucket and k.startswith(prefix) and k > marker)
+        truncated = len(keys) > max_keys
+        xml = ['<?xml version="1.0" encoding="UTF-8"?>\n<ListBucketResult>',
+               '<Name>{0}</Name><Prefix>{1}</Prefix><MaxKeys>{2}</MaxKeys><IsTruncated>{3}</IsTruncated>'.format(
+                   escape(bucket), escape(prefix), max_keys, 'true' if truncated else 'false')]
+        for key in keys[:max_keys]:
+            obj = self.server.objects[(bucket, key)]
+            xml.append('<Contents><Key>{0}</Key><LastModified>2015-01-01T00:00:00.000Z</LastModified>'
+                       '<ETag>"{1}"</ETag><Size>{2}</Size><StorageClass>STANDARD</StorageClass></Contents>'.format(
+                           escape(key), obj.etag, obj.size))
+        xml.append('</ListBucketResult>')
+        self.reply(200, ''.join(xml))
+
+    def list_parts(self, upload_id):
+        upload = self.server.uploads.get(upload_id)
+        if upload is None:
+            return self.reply_error(404, 'NoSuchUpload')
+        xml = ['<?xml version="1.0" encoding="UTF-8"?>\n<ListPartsResult><IsTruncated>false</IsTruncated>']
+        for (part_num, part) in sorted(upload['parts'].items()):
+            xml.append('<Part><PartNumber>{0}</PartNumber><ETag>"{1}"</ETag><Size>{2}</Size></Part>'.format(
+                part_num, part.etag, part.size))
+        xml.append('</ListPartsResult>')
+        self.reply(200, ''.join(xml))
+
+    def get_copy_source(self):
+        source = self.headers.get('x-amz-copy-source')
+        if source is None:
+            return None
+        # The leading slash is optional
+        (source_bucket, source_key) = unquote(source).lstrip('/').split('/', 1)
+        return self.server.objects.get((source_bucket, source_key), False)
+
+    def do_PUT(self):
+        (bucket, key, query) = self.parse_request_path()
+        obj = self.get_copy_source()
+        if obj is False:
+            return self.reply_error(404, 'NoSuchKey')
+
+        if 'uploadId' in query:
+            upload = self.server.uploads.get(query['uploadId'][0])
+            if upload is None:
+                return self.reply_error(404, 'NoSuchUpload')
+            if obj is not None:
+                # Copy of a byte range of another key as the part
+                (start, end) = re.match(r'bytes=(\d+)-(\d+)', self.headers['x-amz-copy-source-range']).groups()
+                (start, end) = (int(start), int(end) + 1)
+                data = obj.data[start:end] if obj.data is not None else None
+                etag = md5(data or '{0}:{1}-{2}'.format(obj.etag, start, end)).hexdigest()
+                upload['parts'][int(query['partNumber'][0])] = StoredObject(end - start, etag, {}, data)
+                return self.reply(200, '<?xml version="1.0" encoding="UTF-8"?>\n<CopyPartResult>'
+                                  '<LastModified>2015-01-01T00:00:00.000Z</LastModified><ETag>"{0}"</ETag>'
+                                  '</CopyPartResult>'.format(etag))
+            (size, etag, data) = self.read_body()
+            upload['parts'][int(query['partNumber'][0])] = StoredObject(size, etag, {}, data)
+            return self.reply(200, '', {'ETag': '"{0}"'.format(etag)})
+
+        if obj is not None:
+            meta = obj.meta
+            if self.headers.get('x-amz-metadata-directive') == 'REPLACE':
+                meta = self.get_meta()
+            self.server.objects[(bucket, key)] = StoredObject(obj.size, obj.etag, meta, obj.data)
+            return self.reply(200, '<?xml version="1.0" encoding="UTF-8"?>\n<CopyObjectResult>'
+                              '<LastModified>2015-01-01T00:00:00.000Z</LastModified><ETag>"{0}"</ETag>'
+                              '</CopyObjectResult>'.format(obj.etag))
+
+        (size, etag, data) = self.read_body()
+        if key:
+            self.server.objects[(bucket, key)] = StoredObject(size, etag, self.get_meta(), data)
+        self.reply(200, '', {'ETag': '"{0}"'.format(etag)})
+
+    def do_POST(self):
+        (bucket, key, query) = self.parse_request_path()
+        # The requests are tiny, so the body is always kept
+        body = self.rfile.read(int(self.headers.get('Content-Length', 0)))
+        if 'uploads' in query:
+            upload_id = uuid4().hex
+            self.server.uploads[upload_id] = {'bucket': bucket, 'key': key, 'meta': self.get_meta(), 'parts': {}}
+            return self.reply(200, '<?xml version="1.0" encoding="UTF-8"?>\n<InitiateMultipartUploadResult>'
+                              '<Bucket>{0}</Bucket><Key>{1}</Key><UploadId>{2}</UploadId>'
+                              '</InitiateMultipartUploadResult>'.format(escape(bucket), escape(key), upload_id))
+
+        if 'uploadId' in query:
+            upload = self.server.uploads.pop(query['uploadId'][0], None)
+            if upload is None:
+                return self.reply_error(404, 'NoSuchUpload')
+            parts = [upload['parts'][int(n)] for n in re.findall(r'<PartNumber>(\d+)</PartNumber>', body)]
+            data = None
+            if self.server.keep_data:
+                data = ''.join(p.data for p in parts)
+            etag = '{0}-{1}'.format(md5(''.join(p.etag for p in parts)).hexdigest(), len(parts))
+            self.server.objects[(bucket, key)] = StoredObject(sum(p.size for p in parts), etag,
+                                                              upload['meta'], data)
+            return self.reply(200, '<?xml version="1.0" encoding="UTF-8"?>\n<CompleteMultipartUploadResult>'
+                              '<Bucket>{0}</Bucket><Key>{1}</Key><ETag>"{2}"</ETag>'
+                              '</CompleteMultipartUploadResult>'.format(escape(bucket), escape(key), etag))
+
+        self.reply_error(400, 'InvalidRequest')
+
+    def do_DELETE(self):
+        (bucket, key, query) = self.parse_request_path()
+        if 'uploadId' in query:
+            if self.server.uploads.pop(query['uploadId'][0], None) is None:
+                return self.reply_error(404, 'NoSuchUpload')
+        else:
+            self.server.objects.pop((bucket, key), None)
+        self.reply(204)
+
+
+
+class S3Stub(ThreadingMixIn, HTTPServer):
+    '''
+    The stub server. Each connection is handled by its own thread, like the
+    separate connections to S3.
+    '''
+
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self, port=0, latency=0.0, rate=0, keep_data=False, verbose=False):
+        HTTPServer.__init__(self, ('127.0.0.1', port), S3StubHandler)
+        self.latency = latency
+        self.rate = rate
+        self.keep_data = keep_data
+        self.verbose = verbose
+        self.lock = Lock()
+        self.reset()
+
+    def reset(self):
+        '''
+        Forget all keys, uploads and statistics.
+        '''
+        with self.lock:
+            self.objects = {}
+            self.uploads = {}
+            self.requests = {}
+            self.bytes_received = 0
+
+    def count_request(self, method):
+        with self.lock:
+            self.requests[method] = self.requests.get(method, 0) + 1
+
+    def count_bytes(self, size):
+        with self.lock:
+            self.bytes_received += size
+
+    @property
+    def endpoint(self):
+        return '{0}:{1}'.format(*self.server_address)
+
+    def start(self):
+        '''
+        Serve in a background thread.
+        '''
+        t = Thread(target=self.serve_forever, name='S3Stub')
+        t.daemon = True
+        t.start()
+        return self
+
+
+
+def main():
+
+    parser = OptionParser(usage="Usage: %prog [options]")
+    parser.add_option("-p", "--port", dest="port", type="int", default=9000,
+                      help="port to listen on (localhost only)", metavar="PORT")
+    parser.add_option("--latency-ms", dest="latency_ms", type="int", default=0,
+                      help="delay before answering each request", metavar="MS")
+    parser.add_option("--rate-kb", dest="rate_kb", type="int", default=0,
+                      help="bandwidth cap per connection in KB/s (0 = unlimited)", metavar="KB")
+    parser.add_option("--keep-data", dest="keep_data", action="store_true", default=False,
+                      help="keep uploaded data in memory, so it can be downloaded again")
+    parser.add_option("-v", "--verbose", dest="verbose", action="store_true", default=False,
+                      help="log every request")
+    (options, args) = parser.parse_args()
+
+    server = S3Stub(options.port, options.latency_ms / 1000.0, options.rate_kb * 1024,
+                    options.keep_data, options.verbose)
+    print "S3 stub listening on", server.endpoint
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+
+
+
+if __name__ == '__main__':
+    main()
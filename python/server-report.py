@@ -10,7 +10,6 @@
 # $Id: server-report 39 2012-10-16 21:49:20Z bnigmann $
 #
 
-import httplib
 import urllib
 import subprocess
 import os
@@ -22,6 +21,7 @@ import getopt
 import json
 
 from sysinf import Sysinf
+from plsversion import PlsVersion
 from socket import timeout
 
 
@@ -452,13 +452,7 @@ try:
 							info['pls']['quiescent_controllers'].append(srv)
 		# Deployed PLS version
 		info['pls']['version'] = 'unknown'
-		pls = httplib.HTTPConnection('localhost', 8080, timeout=10)
-		pls.request('GET', '/Admin/sysinfo/Sysinfo.action?runCheck=com.gwn.plife.sysinfo.checks.AppVersionCheck&authUserName=gwnreporter&authUserPassword=ixNq^4nJJeX1')
-		res = pls.getresponse()
-		if res.status == 200:
-			m = re.search('<app-version>(.*)</app-version>', res.read())
-			if m is not None:
-				info['pls']['version'] = m.group(1)
+		info['pls']['version'] = PlsVersion.get_version(timeout=10) or 'unknown'
 except:
 	pass
 
@@ -480,13 +474,7 @@ try:
 							info['pls']['quiescent_controllers'].append(srv)
 		# Deployed PLS version
 		info['pls']['version'] = 'unknown'
-		pls = httplib.HTTPConnection('localhost', 8080, timeout=20)
-		pls.request('GET', '/Admin/sysinfo/Sysinfo.action?runCheck=com.gwn.plife.sysinfo.checks.AppVersionCheck&authUserName=gwnreporter&authUserPassword=ixNq^4nJJeX1')
-		res = pls.getresponse()
-		if res.status == 200:
-			m = re.search('<app-version>(.*)</app-version>', res.read())
-			if m is not None:
-				info['pls']['version'] = m.group(1)
+		info['pls']['version'] = PlsVersion.get_version(timeout=20) or 'unknown'
 except Exception as e:
         if type(e) == timeout:
 		info['pls']['version'] = 'timeout'
@@ -0,0 +1,150 @@
+#!/usr/bin/python2
+'''
+Tests for backup_to_s3.py. Runs the real script against the local S3 stub
+(s3_stub.py), like benchmark_backup_to_s3.py does.
+
+    python2 -m unittest test_backup_to_s3
+'''
+
+from subprocess import Popen, STDOUT
+from tempfile import mkdtemp, TemporaryFile
+from time import time, sleep
+import json
+import os
+import shutil
+import signal
+import socket
+import sys
+import unittest
+
+from s3_stub import S3Stub
+import backup_to_s3
+
+
+_backup_script = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'backup_to_s3.py')
+
+
+
+class BackupTestCase(unittest.TestCase):
+    '''
+    Runs backup_to_s3.py against a fresh stub, with its state in a temporary
+    directory.
+    '''
+
+    # Bandwidth cap of the stub per connection, 0 is unlimited
+    rate = 0
+    backup_options = []
+
+    def setUp(self):
+        self.work_dir = mkdtemp()
+        self.state_dir = os.path.join(self.work_dir, 'state')
+        self.server = S3Stub(rate=self.rate, keep_data=True).start()
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.server.server_close()
+        shutil.rmtree(self.work_dir)
+
+    def create_file(self, name, size_mb, extra_bytes=0):
+        path = os.path.join(self.work_dir, name)
+        with open(path, 'wb') as f:
+            f.write(os.urandom(size_mb * 1024 * 1024 + extra_bytes))
+        return path
+
+    def start_backup(self, path, output):
+        command = [sys.executable, _backup_script, '--endpoint', self.server.endpoint,
+                   '--state-dir', self.state_dir] + self.backup_options + [path]
+        return Popen(command, stdout=output, stderr=STDOUT)
+
+    def get_remote_object(self, path):
+        key = (backup_to_s3._s3_bucket_name, socket.getfqdn() + '/' + os.path.basename(path))
+        self.assertIn(key, self.server.objects)
+        return self.server.objects[key]
+
+
+
+class UnalignedPartsTest(BackupTestCase):
+    '''
+    Chunks are not sized in whole MB, so most of them start at an offset that
+    mmap cannot map from directly.
+    '''
+
+    backup_options = ['--threshold-mb', '5', '--concurrency', '4']
+
+    def test_odd_file_size(self):
+        # Large enough for chunks above the 5 MB minimum: about 5.06 MB each
+        path = self.create_file('GWN-20240101.tar.gpg', 81, 123)
+
+        with TemporaryFile() as output:
+            p = self.start_backup(path, output)
+            p.wait()
+            output.seek(0)
+            log = output.read()
+        self.assertEqual(p.returncode, 0, log)
+        self.assertIn("Starting multipart transfer", log)
+
+        with open(path, 'rb') as f:
+            self.assertTrue(self.get_remote_object(path).data == f.read())
+
+
+
+class ResumeUploadTest(BackupTestCase):
+    '''
+    An upload that is interrupted has to be finished by the next run, even
+    though that run is given the files of another day.
+    '''
+
+    # Slow enough to interrupt the upload between two chunks
+    rate = 2 * 1024 * 1024
+    backup_options = ['--threshold-mb', '5', '--chunk-size-mb', '5', '--concurrency', '1']
+
+    def get_manifests(self):
+        if not os.path.isdir(self.state_dir):
+            return []
+        return [os.path.join(self.state_dir, name) for name in os.listdir(self.state_dir)
+                if name.endswith('.json')]
+
+    def wait_for_first_chunk(self, p):
+        deadline = time() + 60
+        while time() < deadline and p.poll() is None:
+            for path in self.get_manifests():
+                try:
+                    with open(path, 'r') as f:
+                        if json.load(f)['parts']:
+                            return
+                except (IOError, ValueError):
+                    pass
+            sleep(0.1)
+        self.fail("The upload never got to its first chunk")
+
+    def test_resume_with_other_files(self):
+        yesterday = self.create_file('GWN-20240101.tar.gpg', 20)
+        today = self.create_file('GWN-20240102.tar.gpg', 1)
+
+        with TemporaryFile() as output:
+            p = self.start_backup(yesterday, output)
+            self.wait_for_first_chunk(p)
+            os.kill(p.pid, signal.SIGKILL)
+            p.wait()
+        self.assertEqual(len(self.get_manifests()), 1)
+
+        bytes_before = self.server.bytes_received
+        with TemporaryFile() as output:
+            p = self.start_backup(today, output)
+            p.wait()
+            output.seek(0)
+            log = output.read()
+        self.assertEqual(p.returncode, 0, log)
+        self.assertIn("Resuming multipart transfer", log)
+
+        for path in [yesterday, today]:
+            self.assertEqual(self.get_remote_object(path).size, os.path.getsize(path))
+        # The chunks that made it before the interruption are not sent again
+        self.assertLess(self.server.bytes_received - bytes_before,
+                        os.path.getsize(yesterday) + os.path.getsize(today))
+        self.assertEqual(self.get_manifests(), [])
+
+
+
+if __name__ == '__main__':
+    unittest.main()
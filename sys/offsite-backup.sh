@@ -8,6 +8,11 @@
 ##
 ##      offsite_backup: HQ
 ##
+##  The upload to S3 can be limited to a bandwidth in KB/s by hour of the
+##  day, to leave room for clinical traffic on the uplink:
+##
+##      offsite_bandwidth: 0-6:0,6-24:512
+##
 ##
 
 
@@ -139,10 +144,19 @@ fi
     if [ -x "${S3_BACKUP}" ] ; then
       print_step "Starting backup to Amazon S3: $(date)"
 
-      for FILE in $(find ${SOURCEDIR}/{Assets,GWN,System}*${YESTERDAY}* -type f) ; do
-        ${S3_BACKUP} -f ${FILE} >> ${LOGFILE} 2>&1
-        RET=$(expr ${RET} + $?)
-      done
+      LIMIT=$(grep -E "^offsite_bandwidth:" /etc/gwn/server.conf | sed -e 's/^offsite_bandwidth:[[:space:]]*//')
+      if [ -n "${LIMIT}" ] ; then
+        LIMIT="--limit ${LIMIT}"
+      fi
+
+      # Send all files in one go, so they share the connections and the
+      # listing of what is already in the Cloud. Uploads that did not finish
+      # on an earlier day are added by the script itself.
+      FILES=$(find ${SOURCEDIR}/{Assets,GWN,System}*${YESTERDAY}* -type f)
+      if [ -n "${FILES}" ] ; then
+        ${S3_BACKUP} ${LIMIT} ${FILES} >> ${LOGFILE} 2>&1
+        RET=$?
+      fi
     else
       die "Cannot find or execute ${S3_BACKUP} script"
     fi